@@ -8,12 +8,22 @@ echo Установка зависимостей...
 pip install -r requirements.txt
 
 echo.
-echo Сборка EXE файла...
-pyinstaller --onefile --noconsole --name discount_checker discount_checker.py
+rem build.bat onedir - сборка в папку: exe запускается быстрее, без распаковки во временную папку
+if /i "%~1"=="onedir" (
+    echo Сборка EXE в папку...
+    pyinstaller --noconfirm discount_checker.spec -- --onedir
+) else (
+    echo Сборка EXE файла...
+    pyinstaller --noconfirm discount_checker.spec
+)
 
 echo.
 echo ========================================
 echo Сборка завершена!
-echo EXE файл находится в папке dist\
+if /i "%~1"=="onedir" (
+    echo EXE файл находится в папке dist\discount_checker\
+) else (
+    echo EXE файл находится в папке dist\
+)
 echo ========================================
 pause
\ No newline at end of file
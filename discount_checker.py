@@ -1,38 +1,206 @@
 import asyncio
 import aiohttp
 import ssl
-import pandas as pd
+import os
+import json
 import random
-from typing import List, Dict, Tuple
-from dataclasses import dataclass
+import time
+import hashlib
+import math
+import copy
+import sqlite3
+import bisect
+from collections import OrderedDict
+from array import array
+from typing import List, Dict, Tuple, Optional, TYPE_CHECKING
+from dataclasses import dataclass, asdict
 import logging
+import logging.handlers
+import atexit
+import queue
+import argparse
+import glob
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
+from datetime import datetime
+
+# Ускоренный JSON, если orjson установлен; иначе стандартный json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numpy нужен только при разборе Excel и импортируется там же, здесь - для аннотаций
+if TYPE_CHECKING:
+    import numpy as np
 
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('discount_checker.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 
+def json_dumps(value) -> bytes:
+    """JSON в байтах UTF-8 (тело запроса)"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_loads(data):
+    """Разбор JSON из str или bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class Config:
-    BASE_URL = "https://89.105.216.114"
+    BASE_URL = os.environ.get("DISCOUNT_CHECKER_BASE_URL", "https://89.105.216.114")  # Переменная - для startup_benchmark.py
     USERNAME = "Yulia"
     PASSWORD = "SY1804$@"
     
-    BATCH_SIZE = 100
+    BATCH_SIZE = 100  # Размер страницы discountRule/list
+    PAGE_FETCH_CONCURRENCY = 4  # Сколько страниц правил загружать одновременно
+    
+    # Локальный кэш правил (None = не использовать). Сервер подтверждает только количество правил
+    # и первую страницу, поэтому правка на другой странице видна лишь после RULES_CACHE_TTL.
+    # Кэш читается и пишется, только если выключены кэш тестера, дифференциальная проверка
+    # и локальный расчет (OFFLINE_ENGINE) - им нужны текущие правила сервера
+    RULES_CACHE_FILE = "rules_cache.jsonl"
+    RULES_CACHE_TTL = 30 * 60  # Сколько секунд кэш считается свежим
+    
+    # Загрузка правил: 'auto' - выбор по числу артикулов, 'full' - весь каталог, 'targeted' - по фильтру имени
+    RULE_FETCH_MODE = 'auto'
+    RULE_NAME_FILTER_FIELD = "name"  # Поле фильтра discountRule/list для поиска по имени
+    TARGETED_FETCH_COST_RATIO = 4  # Сколько запросов по фильтру стоят как одна полная страница
+    # Пул соединений и таймауты HTTP-клиента
+    CONNECTION_LIMIT = 100  # Всего соединений в пуле
+    CONNECTION_LIMIT_PER_HOST = 20  # Соединений к одному серверу
+    KEEPALIVE_TIMEOUT = 60  # Сколько секунд держать простаивающее соединение
+    DNS_CACHE_TTL = 600  # Сколько секунд кэшировать DNS
+    CONNECT_TIMEOUT = 10  # Таймаут установки соединения
+    READ_TIMEOUT = 60  # Таймаут чтения ответа
+    TOTAL_TIMEOUT = 120  # Общий таймаут одного запроса
+    
+    COOKIE_FILE = "session_cookies.json"  # Сохраненная сессия (None = авторизоваться при каждом запуске)
+    COOKIE_MAX_AGE = 8 * 60 * 60  # Сколько секунд доверять сохраненной сессии
+    
+    # Синхронизация правил с Excel (--sync-rules)
+    RULE_TEMPLATE_FILE = "manual.json"  # Шаблон правила скидки
+    RULE_SAVE_PATH = "/discountRule/save"  # Эндпоинт создания/обновления правила
+    RULE_SYNC_BAND_GAP = 0.01  # ДО правила 55 = P - зазор, чтобы количество P шло по правилу 50
+    RULE_SYNC_NAMES = {
+        55: "{prefix}_{article}",
+        50: "{prefix}_{article}_ц3",
+    }
+    
+    # Ограничение нагрузки на сервер и повторы
+    RATE_LIMIT_PER_SECOND = 50  # Запросов в секунду (None = без ограничения)
+    RATE_LIMIT_BURST = 20  # Допустимый всплеск запросов
+    AIMD_MIN_CONCURRENCY = 1  # Нижняя граница адаптивного параллелизма
+    AIMD_LATENCY_TARGET = 2.0  # Секунд: медленнее - параллелизм снижается
+    RETRY_ATTEMPTS = 4  # Попыток на запрос (5xx, таймауты, обрывы соединения)
+    RETRY_BACKOFF_BASE = 0.5  # Начальная задержка перед повтором, секунд
+    RETRY_BACKOFF_MAX = 10  # Максимальная задержка перед повтором, секунд
+    
     USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36'
     
     EXCEL_FILE = "data.xlsx"  # Имя Excel файла в корне приложения
+    
+    LOG_FILE = "discount_checker.log"
+    LOG_LEVEL = logging.INFO  # logging.DEBUG - подробности каждой проверки
+    LOG_FORMAT = 'text'  # 'text' или 'json' (JSON-строки в файле лога)
+    STORE_PREFIX = "Ахтирка"  # Префикс магазина в именах правил: "{STORE_PREFIX}_{Артикул}"
+    STORE_PREFIX_BY_FILE = {}  # Префикс магазина для отдельных файлов пакетного режима: {"файл.xlsx": "Магазин"}
+    
+    RANDOM_SEED = None  # Зерно генератора уровней (None = случайное при каждом запуске, пишется в отчет)
+    # Способ выбора уровней: 'random' - генератор с зерном, 'deterministic' - из (артикул, K, P)
+    LEVELS_MODE = 'random'
+    
+    TESTER_CACHE_SIZE = 100_000  # Ответов тестера в памяти (0 = без кэша)
+    # Кэш ответов на диске (None = только в памяти). Используется, только если уровни повторяются
+    # между запусками: LEVELS_MODE = 'deterministic', задан RANDOM_SEED или --resume
+    TESTER_CACHE_FILE = "tester_cache.sqlite3"
+    TESTER_CACHE_MAX_AGE = 7 * 24 * 3600  # Секунд хранения ответа на диске
+    TESTER_CACHE_DISK_SIZE = 500_000  # Максимум ответов на диске (старые удаляются)
+    TESTER_CACHE_WRITE_BATCH = 500  # Ответов в одной транзакции записи
+    
+    CHECKPOINT_FILE = "validation_checkpoint.jsonl"  # Журнал для продолжения прерванной проверки (--resume)
+    # Перепроверять только артикулы, у которых изменилась строка Excel или правила в API (--full - все)
+    DIFFERENTIAL_VALIDATION = True
+    
+    TERMINAL_IDS = [1541]  # Терминалы, на которых проверяется каждый артикул
+    
+    MAX_CONCURRENCY = 10  # Максимум одновременных запросов к API (1 = последовательно)
+    
+    # Пакетный режим тестера: несколько артикулов в одном чеке (1 = по одной позиции)
+    TESTER_BATCH_SIZE = 1
+    TESTER_BATCH_WINDOW = 0.05  # Сколько секунд ждать наполнения пакета
+    # Сочетания (applyMode, isolationLevel), при которых правила артикула не влияют на соседние позиции чека
+    TESTER_BATCH_SAFE_MODES = {(2, 1)}
+    
+    TESTER_DATE = "2025-11-01T16:46:39.609Z"  # Дата чека для тестера и локального расчета скидки
+    
+    # Локальный расчет скидки по правилам из API: тестер вызывается только для выборки и при расхождении
+    OFFLINE_ENGINE = False
+    OFFLINE_SAMPLE_RATE = 0.02  # Доля совпавших локальных расчетов, которые все равно сверяются с API
+    TERMINAL_STORE_IDS = {}  # Магазин терминала для условий правил на магазин: {1541: 1117}
+    # Расчет скидки по discountValueType: 'per_unit' - fixedValue за единицу, 'percent' - процент от суммы
+    DISCOUNT_VALUE_TYPES = {2: 'per_unit'}
+    # Сочетания (applyMode, isolationLevel), для которых действует правило с наибольшим приоритетом
+    OFFLINE_ENGINE_MODES = TESTER_BATCH_SAFE_MODES
 
 
-@dataclass
+class JsonFormatter(logging.Formatter):
+    """Форматирует записи лога как JSON-строки (поля из extra={'fields': {...}})"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Обработчики файла и консоли: их же использует очередь лога дочерних процессов
+_log_handlers = []
+
+
+def setup_logging():
+    """Настройка логирования: запись в файл и консоль идет в отдельном потоке через очередь"""
+    text_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    
+    file_handler = logging.FileHandler(Config.LOG_FILE, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter() if Config.LOG_FORMAT == 'json' else text_formatter)
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(text_formatter)
+    
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler,
+                                              respect_handler_level=True)
+    
+    root = logging.getLogger()
+    root.setLevel(Config.LOG_LEVEL)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    
+    listener.start()
+    atexit.register(listener.stop)
+    _log_handlers[:] = [file_handler, stream_handler]
+
+
+def init_worker_logging(log_queue):
+    """Логирование в дочернем процессе: записи передаются в очередь родительского процесса"""
+    root = logging.getLogger()
+    root.setLevel(Config.LOG_LEVEL)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+
+
+@dataclass(slots=True)
 class RuleSet:
     """Набор правил для одной строки"""
     article: str  # Артикул из столбца C
@@ -60,69 +228,123 @@ class RuleSet:
 class ExcelParser:
     """Парсер Excel файла"""
     
-    def __init__(self, file_path: str):
+    # Индексы используемых столбцов (C, I, K, L, P, Q)
+    ARTICLE_COL = 2
+    PRICE_COL = 8
+    K_COL = 10
+    L_COL = 11
+    P_COL = 15
+    Q_COL = 16
+    
+    def __init__(self, file_path: str, seed: Optional[int] = Config.RANDOM_SEED,
+                 levels_mode: str = Config.LEVELS_MODE):
         self.file_path = file_path
+        # Зерно фиксируем заранее, чтобы записать его в отчет и повторить запуск
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.levels_mode = levels_mode
+    
+    @staticmethod
+    def _row_uniforms(articles: 'np.ndarray', k_value: 'np.ndarray', p_value: 'np.ndarray') -> 'np.ndarray':
+        """Три псевдослучайных числа [0, 1) на строку, зависящих только от (артикул, K, P)"""
+        import numpy as np
+        
+        digests = b''.join(
+            hashlib.blake2b(f"{article}|{k!r}|{p!r}".encode('utf-8'), digest_size=24).digest()
+            for article, k, p in zip(articles.tolist(), k_value.tolist(), p_value.tolist())
+        )
+        return (np.frombuffer(digests, dtype='<u8').reshape(-1, 3) >> np.uint64(11)) / float(2 ** 53)
+    
+    @staticmethod
+    def _to_float(value) -> float:
+        """Число из ячейки; нечисловое значение - NaN (отсекается маской)"""
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return math.nan
+    
+    def _read_columns(self) -> Tuple[List[str], List[bool], 'np.ndarray']:
+        """Потоково читает только столбцы C, I, K, L, P, Q (без DataFrame)"""
+        # Тяжелые модули импортируются только на этапе разбора Excel
+        import numpy as np
+        from openpyxl import load_workbook
+        
+        numeric_cols = [self.PRICE_COL, self.K_COL, self.L_COL, self.P_COL, self.Q_COL]
+        min_col = self.ARTICLE_COL
+        
+        articles = []
+        has_article = []
+        numeric = []
+        to_float = self._to_float
+        
+        workbook = load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            worksheet = workbook.worksheets[0]
+            rows = worksheet.iter_rows(
+                min_row=2, min_col=min_col + 1, max_col=self.Q_COL + 1, values_only=True
+            )
+            for row in rows:
+                row = tuple(row) + (None,) * (self.Q_COL + 1 - min_col - len(row))
+                
+                article = row[0]
+                article_str = '' if article is None else str(article).strip()
+                articles.append(article_str)
+                has_article.append(article_str != '')
+                
+                numeric.append([to_float(row[col - min_col]) for col in numeric_cols])
+        finally:
+            workbook.close()
+        
+        matrix = np.array(numeric, dtype=float) if articles else np.empty((0, len(numeric_cols)))
+        
+        return articles, has_article, matrix
         
     def parse(self) -> List[RuleSet]:
         """Парсит Excel и создает наборы правил для каждой строки"""
+        import numpy as np
+        
         try:
             # Читаем Excel файл
-            df = pd.read_excel(self.file_path)
-            logger.info(f"Excel файл загружен: {len(df)} строк")
+            articles, has_article, numeric = self._read_columns()
+            logger.info(f"Excel файл загружен: {len(articles)} строк")
             
-            rule_sets = []
+            has_article = np.asarray(has_article, dtype=bool)
             
-            for index, row in df.iterrows():
-                # Проверяем, что столбец C не пустой
-                if pd.isna(row.iloc[2]) or str(row.iloc[2]).strip() == '':
-                    continue
-                
-                try:
-                    # Извлекаем значения из столбцов
-                    article = str(row.iloc[2]).strip()  # Столбец C
-                    price = float(row.iloc[8])  # Столбец I
-                    k_value = float(row.iloc[10])  # Столбец K
-                    l_value = float(row.iloc[11])  # Столбец L
-                    p_value = float(row.iloc[15])  # Столбец P
-                    q_value = float(row.iloc[16])  # Столбец Q
-                    
-                    # Создаем уровни (предварительные расчеты)
-                    level_0 = round(random.uniform(0, k_value), 2)
-                    level_1 = round(random.uniform(k_value, p_value), 2)
-                    level_2 = round(p_value * random.uniform(1.5, 3.0), 2)
-                    
-                    # Применяем правила
-                    rule_0 = round(level_0 * price, 2)
-                    rule_1 = round((price - l_value) * level_1, 2)
-                    rule_1_1 = round((price - l_value) * k_value, 2)
-                    rule_2 = round((price - q_value) * level_2, 2)
-                    rule_2_1 = round((price - q_value) * p_value, 2)
-                    
-                    rule_set = RuleSet(
-                        article=article,
-                        price=price,
-                        level_0=level_0,
-                        level_1=level_1,
-                        level_2=level_2,
-                        rule_0=rule_0,
-                        rule_1=rule_1,
-                        rule_1_1=rule_1_1,
-                        rule_2=rule_2,
-                        rule_2_1=rule_2_1,
-                        k_value=k_value,
-                        l_value=l_value,
-                        p_value=p_value,
-                        q_value=q_value
-                    )
-                    
-                    rule_sets.append(rule_set)
-                    logger.debug(f"Создан набор правил для артикула {article}")
-                    
-                except (ValueError, IndexError) as e:
-                    logger.warning(f"Ошибка обработки строки {index + 1}: {e}")
-                    continue
+            # Строки с артикулом, но с нечисловыми значениями отбрасываем
+            is_valid = np.isfinite(numeric).all(axis=1)
+            for index in np.flatnonzero(has_article & ~is_valid):
+                logger.warning(f"Ошибка обработки строки {index + 1}: нечисловое значение в столбцах I/K/L/P/Q")
+            
+            mask = has_article & is_valid
+            price, k_value, l_value, p_value, q_value = numeric[mask].T
+            articles = np.asarray(articles, dtype=object)[mask]
             
-            logger.info(f"Создано {len(rule_sets)} наборов правил")
+            # Создаем уровни (предварительные расчеты)
+            if self.levels_mode == 'deterministic':
+                u0, u1, u2 = self._row_uniforms(articles, k_value, p_value).T
+            else:
+                u0, u1, u2 = np.random.default_rng(self.seed).random((3, len(price)))
+            
+            level_0 = np.round(k_value * u0, 2)
+            level_1 = np.round(k_value + (p_value - k_value) * u1, 2)
+            level_2 = np.round(p_value * (1.5 + 1.5 * u2), 2)
+            
+            # Применяем правила
+            rule_0 = np.round(level_0 * price, 2)
+            rule_1 = np.round((price - l_value) * level_1, 2)
+            rule_1_1 = np.round((price - l_value) * k_value, 2)
+            rule_2 = np.round((price - q_value) * level_2, 2)
+            rule_2_1 = np.round((price - q_value) * p_value, 2)
+            
+            columns = zip(
+                articles.tolist(), price.tolist(),
+                level_0.tolist(), level_1.tolist(), level_2.tolist(),
+                rule_0.tolist(), rule_1.tolist(), rule_1_1.tolist(), rule_2.tolist(), rule_2_1.tolist(),
+                k_value.tolist(), l_value.tolist(), p_value.tolist(), q_value.tolist()
+            )
+            rule_sets = [RuleSet(*values) for values in columns]
+            
+            logger.info(f"Создано {len(rule_sets)} наборов правил "
+                        f"(уровни: {self.levels_mode}, зерно: {self.seed})")
             return rule_sets
             
         except Exception as e:
@@ -130,6 +352,228 @@ class ExcelParser:
             raise
 
 
+class RulesCache:
+    """Локальный кэш правил скидок (JSONL: строка метаданных + по строке на правило)"""
+    
+    def __init__(self, file_path: str):
+        self.file_path = Path(file_path)
+    
+    @staticmethod
+    def page_hash(rules: List[Dict]) -> str:
+        """Хэш содержимого страницы правил"""
+        encoded = json.dumps(rules, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(encoded).hexdigest()
+    
+    def _read(self) -> Tuple[Optional[Dict], List[Dict]]:
+        """Читает метаданные и правила из файла кэша"""
+        if not self.file_path.exists():
+            return None, []
+        
+        try:
+            with open(self.file_path, encoding='utf-8') as f:
+                meta = json_loads(f.readline())
+                rules = [json_loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            logger.warning(f"Кэш правил поврежден и будет пересоздан: {e}")
+            return None, []
+        
+        if len(rules) != meta.get('rules_count'):
+            logger.warning("Кэш правил неполный и будет пересоздан")
+            return None, []
+        
+        return meta, rules
+    
+    def is_fresh(self, max_age: float) -> bool:
+        """Кэш существует и не старше max_age секунд (читается только строка метаданных)"""
+        try:
+            with open(self.file_path, encoding='utf-8') as f:
+                meta = json_loads(f.readline())
+        except (OSError, ValueError):
+            return False
+        return time.time() - meta.get('saved_at', 0) <= max_age
+    
+    def load(self, max_age: float, total_count: int = None,
+             first_page: List[Dict] = None) -> Optional[List[Dict]]:
+        """Возвращает правила из кэша, если он не старше max_age секунд и сервер
+        сообщает то же количество правил и ту же первую страницу"""
+        meta, rules = self._read()
+        if meta is None:
+            return None
+        
+        age = time.time() - meta.get('saved_at', 0)
+        if age > max_age:
+            logger.info(f"Кэш правил устарел ({age:.0f} с), требуется обновление")
+            return None
+        
+        if total_count is not None and meta.get('count') != total_count:
+            logger.info(f"Количество правил на сервере изменилось: {meta.get('count')} → {total_count}, "
+                        f"кэш будет обновлен")
+            return None
+        
+        page_hashes = meta.get('page_hashes') or []
+        if first_page is not None and (not page_hashes or page_hashes[0] != self.page_hash(first_page)):
+            logger.info("Первая страница правил на сервере изменилась, кэш будет обновлен")
+            return None
+        
+        return rules
+    
+    def save(self, pages: List[List[Dict]], total_count: int, rules: List[Dict]):
+        """Сохраняет правила и хэши страниц, сообщая, сколько страниц изменилось"""
+        page_hashes = [self.page_hash(page) for page in pages]
+        
+        old_meta, _ = self._read()
+        if old_meta is not None:
+            old_hashes = old_meta.get('page_hashes', [])
+            changed = sum(1 for i, h in enumerate(page_hashes) if i >= len(old_hashes) or old_hashes[i] != h)
+            if old_meta.get('count') != total_count:
+                logger.info(f"Количество правил на сервере изменилось: {old_meta.get('count')} → {total_count}")
+            logger.info(f"Изменилось страниц правил: {changed} из {len(page_hashes)}")
+        
+        meta = {
+            'saved_at': time.time(),
+            'count': total_count,
+            'rules_count': len(rules),
+            'page_hashes': page_hashes
+        }
+        
+        # Пишем во временный файл и подменяем, чтобы не оставить битый кэш
+        tmp_path = self.file_path.with_name(self.file_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(meta) + '\n')
+            for rule in rules:
+                f.write(json.dumps(rule, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.file_path)
+        
+        logger.info(f"Кэш правил сохранен: {self.file_path}")
+
+
+class RuleIndex:
+    """Индекс правил по (магазин, артикул), строится за один проход по каталогу
+    
+    Магазин и артикул сами могут содержать "_", поэтому имя сопоставляется с известными
+    префиксами магазинов, а не делится по первому "_".
+    """
+    
+    def __init__(self, rules: List[Dict], store_prefixes: List[str] = None):
+        if store_prefixes is None:
+            store_prefixes = [Config.STORE_PREFIX, *Config.STORE_PREFIX_BY_FILE.values()]
+        self._prefixes = sorted(set(store_prefixes))
+        # Суффиксы имен правил после артикула ("_ц3"), как их создает --sync-rules
+        self._suffixes = {template.split('{article}', 1)[1] for template in Config.RULE_SYNC_NAMES.values()} - {''}
+        self._by_key: Dict[Tuple[str, str], List[Dict]] = {}
+        
+        for rule in rules:
+            self.add(rule)
+    
+    def parse_name(self, name: str) -> List[Tuple[str, str]]:
+        """Ключи (магазин, артикул) имени правила: "Ахтирка_3376_ц3" → ("Ахтирка", "3376")"""
+        name = (name or '').strip()
+        keys = []
+        for prefix in self._prefixes:
+            if not name.startswith(prefix + '_'):
+                continue
+            article = name[len(prefix) + 1:]
+            if not article:
+                continue
+            keys.append((prefix, article))
+            for suffix in self._suffixes:
+                if article.endswith(suffix) and len(article) > len(suffix):
+                    keys.append((prefix, article[:-len(suffix)]))
+        return keys
+    
+    @staticmethod
+    def _sku_set_descs(rule: Dict) -> List[str]:
+        """Собирает skuSetIdDesc из resultScaleItems → results → restriction"""
+        descs = []
+        for scale_item in rule.get('resultScaleItems') or []:
+            for result_item in (scale_item or {}).get('results') or []:
+                restriction = (result_item or {}).get('restriction') or {}
+                desc = restriction.get('skuSetIdDesc')
+                if desc:
+                    descs.append(desc)
+        return descs
+    
+    def add(self, rule: Dict):
+        """Добавляет правило в индекс по имени и по skuSetIdDesc"""
+        keys = set()
+        
+        for name in [rule.get('name', ''), *self._sku_set_descs(rule)]:
+            keys.update(self.parse_name(name))
+        
+        for key in keys:
+            self._by_key.setdefault(key, []).append(rule)
+    
+    def get(self, article: str, store_prefix: str) -> List[Dict]:
+        """Правила артикула для магазина"""
+        return self._by_key.get((store_prefix, article), [])
+    
+    def store_prefixes(self) -> List[str]:
+        """Все магазины, встречающиеся в каталоге"""
+        return sorted({prefix for prefix, _ in self._by_key})
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов (token bucket)"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Ждет, пока в ведре появится токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter:
+    """AIMD-ограничитель параллелизма: растет на успехах, вдвое сжимается при ошибках и задержках"""
+    
+    def __init__(self, min_limit: int, max_limit: int, latency_target: float):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.latency_target = latency_target
+        self.limit = float(self.max_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+    
+    async def acquire(self):
+        """Ждет свободного места в пределах текущего лимита"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+    
+    async def release(self, success: bool, latency: float):
+        """Освобождает место и подстраивает лимит по результату запроса"""
+        async with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            
+            if success and latency <= self.latency_target:
+                # Аддитивный рост: примерно +1 за каждые limit успешных запросов
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif now - self._last_decrease >= self.latency_target:
+                # Мультипликативное снижение не чаще одного раза за окно
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._last_decrease = now
+                logger.info(f"Параллелизм запросов снижен до {int(self.limit)} "
+                            f"({'ошибка' if not success else f'задержка {latency:.2f} с'})")
+            
+            self._condition.notify_all()
+
+
 class DiscountRulesAPI:
     """API клиент для работы с системой скидок"""
     
@@ -137,20 +581,168 @@ class DiscountRulesAPI:
         self.config = config
         self.session = None
         self.cookies = None
+        self.rule_index = None
+        self._catalogue_count = None
+        self._login_lock = asyncio.Lock()
+        self._failed_login_cookies = None  # Сессия, для которой повторная авторизация не удалась
         
+        # Общий слой запросов: частота, параллелизм и повторы
+        self.rate_limiter = None
+        if config.RATE_LIMIT_PER_SECOND:
+            self.rate_limiter = TokenBucket(config.RATE_LIMIT_PER_SECOND, config.RATE_LIMIT_BURST)
+        self.limiter = AdaptiveLimiter(config.AIMD_MIN_CONCURRENCY, config.MAX_CONCURRENCY,
+                                       config.AIMD_LATENCY_TARGET)
+        
+        self.headers = {
+            'accept': '*/*',
+            'content-type': 'application/json',
+            'origin': config.BASE_URL,
+            'referer': f"{config.BASE_URL}/",
+            'user-agent': config.USER_AGENT
+        }
+        
+        # Тело запроса тестера кодируется один раз: подставляются только позиции и терминал,
+        # в позицию - артикул, количество, цена и сумма
+        self._tester_item_template = self._template({
+            "extSku": {
+                "id": "__article__"
+            },
+            "quantity": "__quantity__",
+            "price": "__price__",
+            "discount": 0,
+            "coupons": [],
+            "paidByPoints": None,
+            "appliedDiscountAmount": None,
+            "isFullTank": False,
+            "amount": "__amount__"
+        }, ('__article__', '__quantity__', '__price__', '__amount__'))
+        self._tester_payload_template = self._template({
+            "items": "__items__",
+            "promoCodes": "",
+            "cardCode": "",
+            "clientId": "",
+            "payFormType": 0,
+            "terminalId": "__terminal__",
+            "date": config.TESTER_DATE
+        }, ('__items__', '__terminal__'))
+    
+    @staticmethod
+    def _template(payload: Dict, placeholders: Tuple[str, ...]) -> bytes:
+        """Закодированный JSON, где строки-заглушки заменены на %b для подстановки"""
+        encoded = json_dumps(payload).replace(b'%', b'%%')
+        for placeholder in placeholders:
+            encoded = encoded.replace(json_dumps(placeholder), b'%b')
+        return encoded
+
     async def __aenter__(self):
         ssl_context = ssl.create_default_context()
         ssl_context.check_hostname = False
         ssl_context.verify_mode = ssl.CERT_NONE
         
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
-        self.session = aiohttp.ClientSession(connector=connector)
+        # Соединения и TLS-сессии переиспользуются между запросами
+        connector = aiohttp.TCPConnector(
+            ssl=ssl_context,
+            limit=self.config.CONNECTION_LIMIT,
+            limit_per_host=self.config.CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=self.config.KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=self.config.DNS_CACHE_TTL,
+            enable_cleanup_closed=True
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.config.TOTAL_TIMEOUT,
+            sock_connect=self.config.CONNECT_TIMEOUT,
+            sock_read=self.config.READ_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         if self.session:
             await self.session.close()
-            await asyncio.sleep(0.25)  # Даем время на закрытие
+            self.session = None
+    
+    # Статусы, при которых запрос стоит повторить
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    
+    def _backoff_delay(self, attempt: int) -> float:
+        """Экспоненциальная задержка перед повтором со случайным разбросом (full jitter)"""
+        cap = min(self.config.RETRY_BACKOFF_MAX, self.config.RETRY_BACKOFF_BASE * 2 ** (attempt - 1))
+        return random.uniform(0, cap)
+    
+    async def _post(self, url: str, payload, idempotent: bool = True) -> Tuple[int, str]:
+        """POST с повторной авторизацией, если сессия истекла посреди работы
+        
+        payload - словарь или уже закодированное тело (bytes); кодируется один раз на все повторы.
+        Неидемпотентный запрос (создание записи) отправляется один раз: без повторов и без
+        повторной отправки после авторизации, чтобы не создать дубликат.
+        """
+        body = payload if isinstance(payload, bytes) else json_dumps(payload)
+        cookies = self.cookies
+        attempts = None if idempotent else 1
+        status, text, final_path = await self._post_with_retry(url, body, attempts)
+        
+        if not idempotent:
+            if self._is_auth_failure(status, final_path):
+                logger.warning(f"Сессия недействительна (HTTP {status}), повторная авторизация")
+                await self._relogin(cookies)
+            return status, text
+        
+        if self._is_auth_failure(status, final_path):
+            logger.warning(f"Сессия недействительна (HTTP {status}), повторная авторизация")
+            if await self._relogin(cookies):
+                status, text, _ = await self._post_with_retry(url, body)
+        
+        return status, text
+    
+    @staticmethod
+    def _is_auth_failure(status: int, final_path: str) -> bool:
+        """Ответ означает потерю авторизации: 401/403 или редирект на страницу входа"""
+        return status in (401, 403) or final_path.rstrip('/').endswith('/login')
+    
+    async def _relogin(self, stale_cookies) -> bool:
+        """Авторизуется заново один раз на все запросы, упавшие с одной и той же сессией"""
+        async with self._login_lock:
+            # Пока ждали блокировку, сессию мог обновить другой запрос
+            if self.cookies is not stale_cookies:
+                return self.cookies is not None
+            # Для этой сессии вход уже не удался: остальные запросы не повторяют его
+            if stale_cookies is not None and self._failed_login_cookies is stale_cookies:
+                return False
+            if await self.login():
+                return True
+            self._failed_login_cookies = stale_cookies
+            return False
+    
+    async def _post_with_retry(self, url: str, body: bytes, attempts: int = None) -> Tuple[int, str, str]:
+        """POST через общий слой: ограничение частоты, AIMD-параллелизм и повторы"""
+        attempts = max(1, attempts or self.config.RETRY_ATTEMPTS)
+        
+        for attempt in range(1, attempts + 1):
+            if self.rate_limiter:
+                await self.rate_limiter.acquire()
+            await self.limiter.acquire()
+            
+            started = time.monotonic()
+            success = False
+            try:
+                async with self.session.post(url, data=body, headers=self.headers, cookies=self.cookies) as response:
+                    status = response.status
+                    final_path = response.url.path
+                    # Сервер отвечает в UTF-8: без определения кодировки по содержимому
+                    text = await response.text(encoding='utf-8', errors='replace')
+                success = status not in self.RETRY_STATUSES
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                if attempt == attempts:
+                    raise
+                logger.warning(f"Сбой запроса {url}: {type(e).__name__} {e}, повтор {attempt}/{attempts - 1}")
+            else:
+                if success or attempt == attempts:
+                    return status, text, final_path
+                logger.warning(f"HTTP {status} от {url}, повтор {attempt}/{attempts - 1}")
+            finally:
+                await self.limiter.release(success, time.monotonic() - started)
+            
+            await asyncio.sleep(self._backoff_delay(attempt))
     
     async def login(self) -> bool:
         """Авторизация в системе"""
@@ -165,6 +757,7 @@ class DiscountRulesAPI:
                 if response.status == 200:
                     self.cookies = response.cookies
                     logger.info("Авторизация успешна")
+                    self._save_cookies()
                     return True
                 else:
                     text = await response.text()
@@ -174,13 +767,68 @@ class DiscountRulesAPI:
             logger.error(f"Ошибка при авторизации: {e}")
             return False
     
-    async def get_discount_rules_page(self, offset: int = 0) -> Tuple[List[Dict], int]:
-        """Получает одну страницу правил скидок"""
+    async def ensure_login(self) -> bool:
+        """Использует сохраненную сессию, если она есть, иначе авторизуется"""
+        if self._load_cookies():
+            logger.info("Используется сохраненная сессия")
+            return True
+        return await self.login()
+    
+    def _save_cookies(self):
+        """Сохраняет cookies сессии на диск для следующих запусков"""
+        if not self.config.COOKIE_FILE or self.cookies is None:
+            return
+        
+        cookies = {
+            name: getattr(value, 'value', value)
+            for name, value in self.cookies.items()
+        }
+        data = {
+            'base_url': self.config.BASE_URL,
+            'username': self.config.USERNAME,
+            'saved_at': time.time(),
+            'cookies': cookies
+        }
+        
+        try:
+            with open(self.config.COOKIE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить сессию: {e}")
+    
+    def _load_cookies(self) -> bool:
+        """Восстанавливает cookies сохраненной сессии, если она не устарела"""
+        if not self.config.COOKIE_FILE or not Path(self.config.COOKIE_FILE).exists():
+            return False
+        
+        try:
+            with open(self.config.COOKIE_FILE, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать сохраненную сессию: {e}")
+            return False
+        
+        if data.get('base_url') != self.config.BASE_URL or data.get('username') != self.config.USERNAME:
+            return False
+        if time.time() - data.get('saved_at', 0) > self.config.COOKIE_MAX_AGE:
+            return False
+        if not data.get('cookies'):
+            return False
+        
+        self.cookies = data['cookies']
+        return True
+    
+    async def get_discount_rules_page(self, offset: int = 0, name_filter: str = None,
+                                      count: int = None) -> Tuple[List[Dict], Optional[int]]:
+        """Получает одну страницу правил скидок (при name_filter - только подходящие по имени)
+        
+        При ошибке запроса возвращает ([], None), чтобы сбой не путался с пустым результатом.
+        """
         url = f"{self.config.BASE_URL}/discountRule/list"
         
         payload = {
-            "count": self.config.BATCH_SIZE,
-            "filter": {},
+            "count": count or self.config.BATCH_SIZE,
+            "filter": {self.config.RULE_NAME_FILTER_FIELD: name_filter} if name_filter else {},
             "offset": offset,
             "period": {},
             "sort": {
@@ -193,135 +841,226 @@ class DiscountRulesAPI:
             }
         }
         
-        headers = {
-            'accept': '*/*',
-            'content-type': 'application/json',
-            'origin': self.config.BASE_URL,
-            'referer': f"{self.config.BASE_URL}/",
-            'user-agent': self.config.USER_AGENT
-        }
-        
         try:
-            async with self.session.post(url, json=payload, headers=headers, cookies=self.cookies) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get('data', []), data.get('count', 0)
-                else:
-                    text = await response.text()
-                    logger.error(f"Ошибка получения данных: {response.status} - {text}")
-                    return [], 0
+            status, text = await self._post(url, payload)
+            if status == 200:
+                data = json_loads(text)
+                return data.get('data', []), data.get('count', 0)
+            else:
+                logger.error(f"Ошибка получения данных: {status} - {text}")
+                return [], None
         except Exception as e:
             logger.error(f"Ошибка при запросе данных: {e}")
-            return [], 0
+            return [], None
     
-    async def get_all_discount_rules(self) -> List[Dict]:
-        """Получает все правила скидок с учетом пагинации"""
+    async def get_all_discount_rules(self, use_cache: bool = True) -> List[Dict]:
+        """Получает все правила скидок (из локального кэша или с сервера)"""
+        cache = RulesCache(self.config.RULES_CACHE_FILE) if self.config.RULES_CACHE_FILE else None
+        
+        first_page = None
+        total_count = 0
+        if cache and use_cache and cache.is_fresh(self.config.RULES_CACHE_TTL):
+            # Одна страница с сервера подтверждает, что каталог не изменился
+            first_page, total_count = await self.get_discount_rules_page(0)
+            cached_rules = cache.load(max_age=self.config.RULES_CACHE_TTL,
+                                      total_count=total_count, first_page=first_page)
+            if cached_rules is not None:
+                logger.info(f"Всего загружено {len(cached_rules)} правил (из кэша {cache.file_path})")
+                return cached_rules
+        
+        pages, total_count = await self._download_rule_pages(first_page, total_count)
+        
+        # Дедупликация по id: порядок сортировки мог сместиться между запросами
         all_rules = []
-        offset = 0
+        seen_ids = set()
         
-        while True:
-            rules, total_count = await self.get_discount_rules_page(offset)
-            
-            if not rules:
-                break
-            
-            all_rules.extend(rules)
-            logger.info(f"Загружено {len(all_rules)} из {total_count} правил")
-            
-            if len(all_rules) >= total_count:
-                break
-            
-            offset += self.config.BATCH_SIZE
+        for page in pages:
+            for rule in page:
+                rule_id = rule.get('id')
+                if rule_id is not None:
+                    if rule_id in seen_ids:
+                        continue
+                    seen_ids.add(rule_id)
+                all_rules.append(rule)
+        
+        # Неполный каталог (каталог изменился во время загрузки) нельзя ни проверять, ни кэшировать:
+        # артикулы с недостающих страниц ошибочно попали бы в "Нет правил в API"
+        if len(all_rules) < total_count:
+            raise RuntimeError(f"Загружено {len(all_rules)} из {total_count} правил: каталог неполный, "
+                               f"повторите запуск")
+        # Кэш пишется только там, где его читают: при use_cache=False он бы только устаревал на диске
+        if cache and use_cache:
+            cache.save(pages, total_count, all_rules)
         
         logger.info(f"Всего загружено {len(all_rules)} правил")
         return all_rules
     
-    async def find_rules_by_articles(self, articles: List[str]) -> Dict[str, List[Dict]]:
-        """Находит правила для списка артикулов"""
-        all_rules = await self.get_all_discount_rules()
+    async def _download_rule_pages(self, first_page: List[Dict] = None,
+                                   total_count: int = 0) -> Tuple[List[List[Dict]], int]:
+        """Загружает все страницы правил с учетом пагинации"""
+        # Первая страница сообщает общее количество правил (может быть уже получена)
+        if not first_page:
+            first_page, total_count = await self.get_discount_rules_page(0)
         
-        # Группируем правила по артикулам
-        rules_by_article = {article: [] for article in articles}
+        # Пустой ответ - это сбой загрузки, а не пустой каталог: без правил все артикулы
+        # ошибочно попали бы в "Нет правил в API"
+        if not first_page or not total_count:
+            raise RuntimeError("Не удалось загрузить правила скидок: сервер не вернул первую страницу discountRule/list")
         
-        for rule in all_rules:
-            name = rule.get('name', '')
-            
-            # Проверяем структуру "Ахтирка_{Article}"
-            if name.startswith('Ахтирка_'):
-                article = name.split('Ахтирка_', 1)[1]
-                
-                if article in rules_by_article:
-                    rules_by_article[article].append(rule)
+        logger.info(f"Загружено {len(first_page)} из {total_count} правил")
+        
+        # Сервер может урезать страницу, поэтому шаг берем по фактическому размеру
+        page_size = len(first_page)
+        offsets = range(page_size, total_count, page_size)
+        semaphore = asyncio.Semaphore(max(1, self.config.PAGE_FETCH_CONCURRENCY))
+        
+        async def fetch_page(offset: int) -> Tuple[List[Dict], Optional[int]]:
+            async with semaphore:
+                return await self.get_discount_rules_page(offset)
         
-        # Логируем результаты
+        # Остальные страницы загружаем параллельно
+        responses = await asyncio.gather(*(fetch_page(offset) for offset in offsets))
+        
+        # Страницы, не полученные и после повторов запроса, запрашиваем еще раз по одной
+        pages = []
+        for offset, (rules, count) in zip(offsets, responses):
+            if count is None:
+                logger.warning(f"Страница правил со смещением {offset} не получена, повторная загрузка")
+                rules, count = await self.get_discount_rules_page(offset)
+                if count is None:
+                    raise RuntimeError(f"Не удалось загрузить страницу правил со смещением {offset}")
+            pages.append(rules)
+        
+        return [first_page, *pages], total_count
+    
+    async def get_rules_by_names(self, names: List[str]) -> List[Dict]:
+        """Загружает только правила, подходящие под имена (фильтр на стороне сервера)"""
+        semaphore = asyncio.Semaphore(max(1, self.config.PAGE_FETCH_CONCURRENCY))
+        
+        async def fetch_name(name: str) -> List[Dict]:
+            rules = []
+            async with semaphore:
+                while True:
+                    page, total_count = await self.get_discount_rules_page(len(rules), name_filter=name)
+                    # Сбой запроса - не "нет правил": иначе артикул ошибочно попал бы в "Нет правил в API"
+                    if total_count is None:
+                        raise RuntimeError(f"Не удалось загрузить правила по фильтру имени {name!r}")
+                    rules.extend(page)
+                    if not page or len(rules) >= total_count:
+                        return rules
+        
+        pages = await asyncio.gather(*(fetch_name(name) for name in names))
+        
+        # Одно правило может подойти под несколько фильтров
+        found = {}
+        for page in pages:
+            for rule in page:
+                found.setdefault(rule.get('id', id(rule)), rule)
+        
+        logger.info(f"Загружено {len(found)} правил по {len(names)} фильтрам имени")
+        return list(found.values())
+    
+    async def _prefer_targeted_fetch(self, article_count: int, use_cache: bool = True) -> bool:
+        """Выбирает загрузку по фильтру имени вместо полного каталога"""
+        mode = self.config.RULE_FETCH_MODE
+        if mode != 'auto':
+            return mode == 'targeted'
+        
+        # Свежий локальный кэш обходится без запросов вообще
+        if (use_cache and self.config.RULES_CACHE_FILE
+                and RulesCache(self.config.RULES_CACHE_FILE).is_fresh(self.config.RULES_CACHE_TTL)):
+            return False
+        
+        # Размер каталога узнаем запросом одной записи
+        if self._catalogue_count is None:
+            _, self._catalogue_count = await self.get_discount_rules_page(0, count=1)
+            if self._catalogue_count is None:
+                raise RuntimeError("Не удалось узнать размер каталога правил")
+        
+        full_requests = -(-self._catalogue_count // self.config.BATCH_SIZE)
+        targeted = article_count <= full_requests * self.config.TARGETED_FETCH_COST_RATIO
+        logger.info(f"Загрузка правил: {'по артикулам' if targeted else 'весь каталог'} "
+                    f"({article_count} артикулов, {self._catalogue_count} правил в каталоге)")
+        return targeted
+    
+    async def get_rule_index(self, articles: List[str] = None, store_prefix: str = None,
+                             use_cache: bool = True) -> RuleIndex:
+        """Возвращает индекс правил (каталог загружается один раз за сессию)"""
+        if self.rule_index is not None:
+            return self.rule_index
+        
+        # Для небольшого набора артикулов загружаем только их правила
+        if articles and store_prefix:
+            unique_articles = list(dict.fromkeys(articles))
+            if await self._prefer_targeted_fetch(len(unique_articles), use_cache):
+                names = [f"{store_prefix}_{article}" for article in unique_articles]
+                return RuleIndex(await self.get_rules_by_names(names), [store_prefix])
+        
+        all_rules = await self.get_all_discount_rules(use_cache=use_cache)
+        self.rule_index = RuleIndex(all_rules)
+        return self.rule_index
+    
+    async def find_rules_by_articles(self, articles: List[str], store_prefix: str = None,
+                                     use_cache: bool = True) -> Dict[str, List[Dict]]:
+        """Находит правила для списка артикулов"""
+        store_prefix = store_prefix or self.config.STORE_PREFIX
+        rule_index = await self.get_rule_index(articles, store_prefix, use_cache=use_cache)
+        
+        # Правила вида "{Магазин}_{Article}[_суффикс]" ищем по индексу
+        rules_by_article = {article: rule_index.get(article, store_prefix) for article in articles}
+        
+        # Логируем результаты (по артикулам - только на уровне DEBUG)
+        without_rules = 0
         for article, rules in rules_by_article.items():
             if rules:
-                logger.info(f"Для артикула {article} найдено {len(rules)} правил")
+                logger.debug("Для артикула %s найдено %s правил", article, len(rules))
             else:
-                logger.warning(f"Для артикула {article} не найдено правил")
+                without_rules += 1
+                logger.debug("Для артикула %s не найдено правил", article)
+        
+        logger.info("Правила найдены для %s из %s артикулов", len(rules_by_article) - without_rules,
+                    len(rules_by_article))
         
         return rules_by_article
     
-    async def test_discount_rule(self, article: str, quantity: float, price: float, terminal_id: int = 1541) -> Dict:
-        """Тестирует правило скидки"""
+    def _tester_item(self, article: str, quantity: float, price: float) -> bytes:
+        """Позиция чека для discountRuleTester (закодированный JSON)"""
+        return self._tester_item_template % (
+            json_dumps(article),
+            json_dumps(quantity),
+            json_dumps(str(price)),
+            json_dumps(round(quantity * price, 2))
+        )
+    
+    async def _process_tester(self, items: List[bytes], terminal_id: int) -> Dict:
+        """Отправляет чек с позициями в discountRuleTester/process"""
         url = f"{self.config.BASE_URL}/discountRuleTester/process"
         
-        payload = {
-            "items": [
-                {
-                    "extSku": {
-                        "id": article
-                    },
-                    "quantity": quantity,
-                    "price": str(price),
-                    "discount": 0,
-                    "coupons": [],
-                    "paidByPoints": None,
-                    "appliedDiscountAmount": None,
-                    "isFullTank": False,
-                    "amount": round(quantity * price, 2)
-                }
-            ],
-            "promoCodes": "",
-            "cardCode": "",
-            "clientId": "",
-            "payFormType": 0,
-            "terminalId": terminal_id,
-            "date": "2025-11-01T16:46:39.609Z"
-        }
-        
-        headers = {
-            'accept': '*/*',
-            'content-type': 'application/json',
-            'origin': self.config.BASE_URL,
-            'referer': f"{self.config.BASE_URL}/",
-            'user-agent': self.config.USER_AGENT
-        }
+        payload = self._tester_payload_template % (b'[' + b','.join(items) + b']', json_dumps(terminal_id))
         
         try:
-            async with self.session.post(url, json=payload, headers=headers, cookies=self.cookies) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return {
-                        'success': True,
-                        'data': data,
-                        'total_discount': data.get('data', {}).get('totalDiscountAmount', 0)
-                    }
-                else:
-                    text = await response.text()
-                    # Проверяем на ошибку БД - артикул не найден
-                    if 'is not present in table' in text or 'ext_sku_group_id' in text:
-                        return {
-                            'success': False,
-                            'error': 'Артикул не найден в системе',
-                            'total_discount': 0
-                        }
-                    logger.error(f"Ошибка тестирования правила: {response.status} - {text}")
+            status, text = await self._post(url, payload)
+            if status == 200:
+                data = json_loads(text)
+                return {
+                    'success': True,
+                    'data': data,
+                    'total_discount': data.get('data', {}).get('totalDiscountAmount', 0)
+                }
+            else:
+                # Проверяем на ошибку БД - артикул не найден
+                if 'is not present in table' in text or 'ext_sku_group_id' in text:
                     return {
                         'success': False,
-                        'error': text[:200],  # Ограничиваем длину
+                        'error': 'Артикул не найден в системе',
                         'total_discount': 0
                     }
+                logger.error(f"Ошибка тестирования правила: {status} - {text}")
+                return {
+                    'success': False,
+                    'error': text[:200],  # Ограничиваем длину
+                    'total_discount': 0
+                }
         except Exception as e:
             logger.error(f"Ошибка при тестировании правила: {e}")
             return {
@@ -329,9 +1068,444 @@ class DiscountRulesAPI:
                 'error': str(e)[:200],
                 'total_discount': 0
             }
+    
+    async def test_discount_rule(self, article: str, quantity: float, price: float, terminal_id: int = 1541) -> Dict:
+        """Тестирует правило скидки"""
+        return await self._process_tester([self._tester_item(article, quantity, price)], terminal_id)
+    
+    @staticmethod
+    def _item_discount(item: Dict) -> Optional[float]:
+        """Скидка по одной позиции из ответа тестера"""
+        if not isinstance(item, dict):
+            return None
+        
+        for key in ('discountAmount', 'totalDiscountAmount', 'discount'):
+            value = item.get(key)
+            if value is not None:
+                try:
+                    return float(value)
+                except (ValueError, TypeError):
+                    return None
+        return None
+    
+    async def test_discount_rules_batch(self, cases: List[Tuple[str, float, float]],
+                                        terminal_id: int = 1541) -> Optional[List[Dict]]:
+        """Тестирует несколько позиций (артикул, количество, цена) одним чеком.
+        
+        Возвращает None, если ответ нельзя разложить по позициям - тогда
+        позиции нужно проверить по одной.
+        """
+        items = [self._tester_item(article, quantity, price) for article, quantity, price in cases]
+        result = await self._process_tester(items, terminal_id)
+        
+        if not result['success']:
+            return None
+        
+        data_obj = (result['data'] or {}).get('data') or {}
+        response_items = data_obj.get('items')
+        if not isinstance(response_items, list) or len(response_items) != len(cases):
+            return None
+        
+        discounts = [self._item_discount(item) for item in response_items]
+        if any(discount is None for discount in discounts):
+            return None
+        
+        # Сумма скидок по позициям должна сходиться с итогом чека
+        total_discount = float(data_obj.get('totalDiscountAmount') or 0)
+        if abs(sum(discounts) - total_discount) > 0.01:
+            return None
+        
+        return [
+            {'success': True, 'data': item, 'total_discount': discount}
+            for item, discount in zip(response_items, discounts)
+        ]
+    
+    async def save_discount_rule(self, rule: Dict) -> Dict:
+        """Создает (id = None) или обновляет правило скидки"""
+        url = f"{self.config.BASE_URL}{self.config.RULE_SAVE_PATH}"
+        
+        try:
+            # Создание (id = None) не повторяется: медленный, но принятый сервером ответ дал бы дубликат
+            status, text = await self._post(url, rule, idempotent=rule.get('id') is not None)
+            if status == 200:
+                return {'success': True}
+            logger.error(f"Ошибка сохранения правила {rule.get('name')}: {status} - {text}")
+            return {'success': False, 'error': text[:200]}
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении правила {rule.get('name')}: {e}")
+            return {'success': False, 'error': str(e)[:200]}
+
+
+class TesterBatcher:
+    """Собирает одиночные проверки в пакетные запросы к discountRuleTester/process"""
+    
+    def __init__(self, api: DiscountRulesAPI, semaphore: asyncio.Semaphore,
+                 batch_size: int, window: float):
+        self.api = api
+        self.semaphore = semaphore
+        self.batch_size = batch_size
+        self.window = window
+        self._open_batches: Dict[int, List[List]] = {}
+        self._tasks = set()
+    
+    async def submit(self, article: str, quantity: float, price: float, terminal_id: int) -> Dict:
+        """Ставит позицию в ближайший пакет и ждет ее результат"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        batch = self._find_batch(terminal_id, article)
+        batch.append(((article, quantity, price), future))
+        
+        if len(batch) >= self.batch_size:
+            self._dispatch(terminal_id, batch)
+        elif len(batch) == 1:
+            loop.call_later(self.window, self._dispatch, terminal_id, batch)
+        
+        return await future
+    
+    def _find_batch(self, terminal_id: int, article: str) -> List:
+        """Открытый пакет без этого артикула (один артикул - одна позиция в чеке)"""
+        batches = self._open_batches.setdefault(terminal_id, [])
+        
+        for batch in batches:
+            if len(batch) < self.batch_size and all(case[0] != article for case, _ in batch):
+                return batch
+        
+        batch = []
+        batches.append(batch)
+        return batch
+    
+    def _dispatch(self, terminal_id: int, batch: List):
+        """Закрывает пакет и отправляет его (повторный вызов игнорируется)"""
+        batches = self._open_batches.get(terminal_id, [])
+        for i, open_batch in enumerate(batches):
+            if open_batch is batch:
+                del batches[i]
+                break
+        else:
+            return
+        
+        task = asyncio.ensure_future(self._send(terminal_id, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _send(self, terminal_id: int, batch: List):
+        """Отправляет пакет, при невозможности разложить ответ - проверяет по одной позиции"""
+        cases = [case for case, _ in batch]
+        
+        try:
+            results = None
+            if len(cases) > 1:
+                async with self.semaphore:
+                    results = await self.api.test_discount_rules_batch(cases, terminal_id)
+                if results is None:
+                    logger.debug(f"Пакет из {len(cases)} позиций не разложен по позициям, проверка по одной")
+            
+            if results is None:
+                results = await asyncio.gather(*(self._send_single(case, terminal_id) for case in cases))
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+    
+    async def _send_single(self, case: Tuple[str, float, float], terminal_id: int) -> Dict:
+        article, quantity, price = case
+        async with self.semaphore:
+            return await self.api.test_discount_rule(article, quantity, price, terminal_id)
+
+
+class TesterCache:
+    """Кэш ответов тестера: LRU в памяти и, при желании, SQLite на диске"""
+    
+    def __init__(self, max_size: int, file_path: Optional[str] = None,
+                 max_age: float = Config.TESTER_CACHE_MAX_AGE,
+                 disk_size: int = Config.TESTER_CACHE_DISK_SIZE,
+                 write_batch: int = Config.TESTER_CACHE_WRITE_BATCH):
+        self.max_size = max_size
+        self.write_batch = max(1, write_batch)
+        self._memory = OrderedDict()
+        self._pending = []  # Ответы, еще не записанные на диск
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+        
+        if file_path:
+            self._db = sqlite3.connect(file_path, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, result TEXT, saved_at REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_saved_at ON responses (saved_at)")
+            self._prune(max_age, disk_size)
+    
+    def _prune(self, max_age: float, disk_size: int):
+        """Удаляет устаревшие ответы и самые старые сверх disk_size"""
+        self._db.execute("DELETE FROM responses WHERE saved_at < ?", (time.time() - max_age,))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY saved_at DESC LIMIT -1 OFFSET ?)",
+            (disk_size,)
+        )
+    
+    @staticmethod
+    def fingerprint(api_rules: List[Dict]) -> str:
+        """Отпечаток правил артикула: любое изменение правила меняет ключи его проверок"""
+        ordered = sorted(api_rules, key=lambda rule: str(rule.get('id')))
+        encoded = json.dumps(ordered, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(encoded).hexdigest()
+    
+    @staticmethod
+    def key(article: str, quantity: float, price: float, terminal_id: int, rules_fingerprint: str) -> str:
+        # Кэш на диске переживает смену сервера и даты чека в настройках
+        return (f"{Config.BASE_URL}|{Config.TESTER_DATE}|{article}|{quantity!r}|{price!r}|"
+                f"{terminal_id}|{rules_fingerprint}")
+    
+    def get(self, key: str) -> Optional[Dict]:
+        """Ответ из кэша или None"""
+        result = self._memory.get(key)
+        if result is not None:
+            self._memory.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute("SELECT result FROM responses WHERE key = ?", (key,)).fetchone()
+            if row:
+                result = json.loads(row[0])
+                self._remember(key, result)
+        
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+    
+    def put(self, key: str, result: Dict):
+        """Запоминает успешный ответ (храним только то, что нужно валидатору)"""
+        if not result.get('success'):
+            return
+        
+        stored = {'success': True, 'total_discount': result['total_discount']}
+        self._remember(key, stored)
+        
+        if self._db is not None:
+            self._pending.append((key, json.dumps(stored), time.time()))
+            if len(self._pending) >= self.write_batch:
+                self.flush()
+    
+    def flush(self):
+        """Записывает накопленные ответы на диск одной транзакцией"""
+        if self._db is None or not self._pending:
+            return
+        # Соединение в режиме автофиксации: транзакцию открываем явно
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO responses (key, result, saved_at) VALUES (?, ?, ?)",
+                self._pending
+            )
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        self._pending = []
+    
+    def _remember(self, key: str, result: Dict):
+        self._memory[key] = result
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+    
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
 
 
 @dataclass
+class DiscountBand:
+    """Диапазон количества одного результата правила для локального расчета"""
+    priority: int
+    quantity_from: float
+    quantity_to: Optional[float]  # None - без ДО
+    value_type: Optional[int]
+    fixed_value: float
+    store_ids: Optional[frozenset]  # None - правило без условия на магазин
+
+
+class DiscountEngine:
+    """Локальный расчет totalDiscountAmount по правилам артикула из discountRule/list
+    
+    Если правила содержат то, что движок не умеет считать (условия на чек, неизвестные
+    условия, тип скидки или режим применения), predict() возвращает None и проверка
+    идет через тестер.
+    """
+    
+    STORE_CONDITION = (1, 8)  # (type, comparsionType) условия "магазин из списка"
+    
+    # Поля, которые движок не моделирует: правило считается локально, только если они имеют
+    # значения как в шаблоне manual.json (отсутствующее поле - тоже значение по умолчанию)
+    UNMODELED_RULE_FIELDS = {'onlyMessageMode': 0, 'schedulingMode': 0}
+    UNMODELED_SCALE_FIELDS = {'type': 9, 'comparsionType': 0}
+    UNMODELED_RESULT_FIELDS = {'discountTimeType': 0, 'valueType': 0}
+    UNMODELED_RESTRICTION_FIELDS = {'exceptSkuSetId': None, 'groupApplyMode': 1, 'sortItemsMode': 1}
+    
+    def __init__(self, api_rules: List[Dict], date: str = Config.TESTER_DATE):
+        self.supported = True
+        bands = []
+        moment = self._parse_date(date)
+        
+        for rule in api_rules:
+            if not self._is_active(rule, moment):
+                continue
+            compiled = self._compile_rule(rule)
+            if compiled is None:
+                self.supported = False
+                break
+            bands.extend(compiled)
+        
+        bands.sort(key=lambda band: band.quantity_from)
+        self._bands = bands
+        self._starts = [band.quantity_from for band in bands]
+    
+    @staticmethod
+    def _parse_date(value: Optional[str]) -> Optional[datetime]:
+        if not value:
+            return None
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    
+    @classmethod
+    def _is_active(cls, rule: Dict, moment: Optional[datetime]) -> bool:
+        """Правило включено и дата чека попадает в период действия"""
+        if rule.get('status') != 1:
+            return False
+        if moment is None:
+            return True
+        begin = cls._parse_date(rule.get('beginDate'))
+        end = cls._parse_date(rule.get('endDate'))
+        return (begin is None or begin <= moment) and (end is None or moment <= end)
+    
+    @classmethod
+    def _store_ids(cls, rule: Dict):
+        """Магазины из условий правила; False - есть условие, которое движок не знает"""
+        store_ids = None
+        for condition in rule.get('ruleConditions') or []:
+            if (condition.get('type'), condition.get('comparsionType')) != cls.STORE_CONDITION:
+                return False
+            try:
+                ids = json.loads(condition.get('value') or '{}').get('ids') or []
+            except (ValueError, AttributeError):
+                return False
+            store_ids = frozenset(ids) if store_ids is None else store_ids & frozenset(ids)
+        return store_ids
+    
+    @staticmethod
+    def _has_defaults(item: Dict, defaults: Dict) -> bool:
+        return all(item.get(field, default) == default for field, default in defaults.items())
+    
+    @classmethod
+    def _compile_rule(cls, rule: Dict) -> Optional[List[DiscountBand]]:
+        """Диапазоны правила или None, если правило нельзя посчитать локально"""
+        # Условия на весь чек зависят от соседних позиций
+        if rule.get('orderConditions'):
+            return None
+        # "Побеждает наибольший приоритет" проверено только для этих режимов; при суммировании
+        # скидок неверный расчет мог бы совпасть с ожиданием и скрыть ошибку правила
+        if (rule.get('applyMode'), rule.get('isolationLevel')) not in Config.OFFLINE_ENGINE_MODES:
+            return None
+        # Сообщение без скидки, расписание и т.п.: сервер может не дать скидку там, где движок ее насчитает
+        if not cls._has_defaults(rule, cls.UNMODELED_RULE_FIELDS):
+            return None
+        store_ids = cls._store_ids(rule)
+        if store_ids is False:
+            return None
+        
+        bands = []
+        for scale_item in rule.get('resultScaleItems') or []:
+            if scale_item and not cls._has_defaults(scale_item, cls.UNMODELED_SCALE_FIELDS):
+                return None
+            for result_item in (scale_item or {}).get('results') or []:
+                if not result_item:
+                    continue
+                restriction = result_item.get('restriction') or {}
+                if (not cls._has_defaults(result_item, cls.UNMODELED_RESULT_FIELDS)
+                        or not cls._has_defaults(restriction, cls.UNMODELED_RESTRICTION_FIELDS)):
+                    return None
+                value_type = result_item.get('discountValueType')
+                if value_type not in Config.DISCOUNT_VALUE_TYPES:
+                    return None
+                try:
+                    fixed_value = float(result_item.get('fixedValue'))
+                except (ValueError, TypeError):
+                    return None
+                
+                from_value = 0.0
+                to_value = None
+                for condition in restriction.get('conditions') or []:
+                    try:
+                        value = float(condition.get('value'))
+                    except (ValueError, TypeError):
+                        return None
+                    if condition.get('type') == 6:  # не менше (ОТ)
+                        from_value = value
+                    elif condition.get('type') == 1:  # не більше (ДО)
+                        to_value = value
+                    else:
+                        return None
+                
+                bands.append(DiscountBand(
+                    priority=rule.get('priority', 0),
+                    quantity_from=from_value,
+                    quantity_to=to_value,
+                    value_type=value_type,
+                    fixed_value=fixed_value,
+                    store_ids=store_ids
+                ))
+        return bands
+    
+    def predict(self, quantity: float, price: float, terminal_id: int) -> Optional[float]:
+        """Ожидаемая скидка сервера или None, если локально ее не определить"""
+        if not self.supported:
+            return None
+        
+        store_id = Config.TERMINAL_STORE_IDS.get(terminal_id)
+        matched = []
+        for band in self._bands[:bisect.bisect_right(self._starts, quantity)]:
+            if band.quantity_to is not None and quantity > band.quantity_to:
+                continue
+            if band.store_ids is not None:
+                # Без привязки терминала к магазину условие не проверить
+                if store_id is None:
+                    return None
+                if store_id not in band.store_ids:
+                    continue
+            matched.append(band)
+        
+        amount = round(quantity * price, 2)
+        if not matched:
+            return 0.0
+        
+        # Применяется правило с наибольшим приоритетом; разные скидки на одном приоритете неоднозначны
+        top = max(band.priority for band in matched)
+        winners = {(band.value_type, band.fixed_value) for band in matched if band.priority == top}
+        if len(winners) > 1:
+            return None
+        value_type, fixed_value = winners.pop()
+        
+        if Config.DISCOUNT_VALUE_TYPES[value_type] == 'per_unit':
+            discount = fixed_value * quantity
+        else:
+            discount = amount * fixed_value / 100
+        return round(min(discount, amount), 2)
+
+
+@dataclass(slots=True)
 class ValidationCheck:
     """Результат проверки одного правила"""
     rule_name: str
@@ -343,20 +1517,155 @@ class ValidationCheck:
     difference: float
     status: str  # 'OK', 'FAIL', 'ERROR'
     error: str = None
+    verified_by: str = 'API'  # 'API' или 'Локально' (расчет DiscountEngine без запроса)
+
+
+class ResultStore:
+    """Результаты проверки по столбцам: строка на артикул и строка на проверку правила
+    
+    Итоги (всего, по файлам, по терминалам) считаются при добавлении, отчет читает столбцы.
+    Результаты добавляются по мере готовности, порядок входных строк восстанавливает rows().
+    """
+    
+    COUNTERS = ('total', 'completed', 'no_rules', 'ok', 'fail', 'error')
+    
+    def __init__(self):
+        # Столбцы артикулов
+        self.indices = array('q')  # Номер входной строки (артикул × терминал)
+        self.sources = []
+        self.articles = []
+        self.terminal_ids = array('q')
+        self.prices = array('d')
+        self.statuses = []
+        self.check_starts = array('q')  # Первая строка проверок артикула
+        self.check_counts = array('B')  # Проверок у артикула (строки идут подряд)
+        self.seeds = []  # Зерно уровней запуска, в котором артикул проверен (None - неизвестно)
+        
+        # Столбцы проверок
+        self.rule_names = []
+        self.quantities = array('d')
+        self.prices_without_discount = array('d')
+        self.prices_with_discount = array('d')
+        self.expected_discounts = array('d')
+        self.actual_discounts = array('d')
+        self.differences = array('d')
+        self.check_statuses = []
+        self.errors = []
+        self.verified_by = []
+        
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.by_source = {}
+        self.by_terminal = {}
+    
+    def __len__(self) -> int:
+        return len(self.articles)
+    
+    def add(self, result: Dict, index: Optional[int] = None):
+        """Добавляет результат валидатора по артикулу"""
+        checks = result['checks']
+        self.indices.append(len(self.articles) if index is None else index)
+        self.sources.append(result.get('source'))
+        self.articles.append(result['article'])
+        self.terminal_ids.append(result.get('terminal_id') or 0)
+        self.prices.append(result['price'])
+        self.statuses.append(result['status'])
+        self.check_starts.append(len(self.rule_names))
+        self.check_counts.append(len(checks))
+        self.seeds.append(result.get('seed'))
+        
+        for check in checks:
+            self.rule_names.append(check.rule_name)
+            self.quantities.append(check.quantity)
+            self.prices_without_discount.append(check.price_without_discount)
+            self.prices_with_discount.append(check.price_with_discount)
+            self.expected_discounts.append(check.expected_discount)
+            self.actual_discounts.append(check.actual_discount)
+            self.differences.append(check.difference)
+            self.check_statuses.append(check.status)
+            self.errors.append(check.error or None)
+            self.verified_by.append(check.verified_by)
+        
+        increments = {
+            'total': 1,
+            'completed': result['status'] == 'COMPLETED',
+            'no_rules': result['status'] == 'NO_API_RULES',
+            'ok': result.get('ok_count', 0),
+            'fail': result.get('fail_count', 0),
+            'error': result.get('error_count', 0),
+        }
+        for counts in (self.totals,
+                       self.by_source.setdefault(result.get('source'), dict.fromkeys(self.COUNTERS, 0)),
+                       self.by_terminal.setdefault(result.get('terminal_id'), dict.fromkeys(self.COUNTERS, 0))):
+            for name, value in increments.items():
+                counts[name] += value
+    
+    def rows(self):
+        """Строки отчета прямо из столбцов в порядке входных строк"""
+        for row in sorted(range(len(self.articles)), key=self.indices.__getitem__):
+            head = [self.sources[row], self.articles[row], self.terminal_ids[row] or None,
+                    self.prices[row]]
+            status = self.statuses[row]
+            seed = self.seeds[row]
+            
+            if status == 'NO_API_RULES':
+                yield head + ['Нет правил в API'] + [None] * 10 + [seed]
+                continue
+            
+            start = self.check_starts[row]
+            for check in range(start, start + self.check_counts[row]):
+                yield head + [
+                    status,
+                    self.rule_names[check],
+                    self.quantities[check],
+                    self.prices_without_discount[check],
+                    self.prices_with_discount[check],
+                    self.expected_discounts[check],
+                    self.actual_discounts[check],
+                    self.differences[check],
+                    self.check_statuses[check],
+                    self.errors[check],
+                    self.verified_by[check],
+                    seed
+                ]
 
 
 class RulesValidator:
     """Валидатор правил"""
     
-    def __init__(self, api: DiscountRulesAPI, terminal_id: int = 1541):
+    def __init__(self, api: DiscountRulesAPI, terminal_id: int = 1541,
+                 max_concurrency: int = Config.MAX_CONCURRENCY,
+                 batch_size: int = Config.TESTER_BATCH_SIZE,
+                 cache: Optional[TesterCache] = None,
+                 offline_engine: bool = Config.OFFLINE_ENGINE):
         self.api = api
         self.terminal_id = terminal_id
-        self.results = []
+        self.cache = cache
+        self.offline_engine = offline_engine
+        self.offline_checks = 0  # Проверок, засчитанных по локальному расчету
+        self.offline_mismatches = 0  # Локальный расчет разошелся с ответом API
+        self.semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self.batcher = None
+        if batch_size > 1:
+            self.batcher = TesterBatcher(api, self.semaphore, batch_size, Config.TESTER_BATCH_WINDOW)
+        self.results = ResultStore()
+    
+    @staticmethod
+    def _is_batchable(api_rules: List[Dict]) -> bool:
+        """Можно ли проверять артикул в общем чеке с другими артикулами"""
+        for rule in api_rules:
+            # Условия на весь чек зависят от соседних позиций
+            if rule.get('orderConditions'):
+                return False
+            if (rule.get('applyMode'), rule.get('isolationLevel')) not in Config.TESTER_BATCH_SAFE_MODES:
+                return False
+        return True
     
-    async def validate(self, rule_set: RuleSet, api_rules: List[Dict]) -> Dict:
+    async def validate(self, rule_set: RuleSet, api_rules: List[Dict], terminal_id: int = None) -> Dict:
         """Проверяет правила из API против расчетных правил"""
+        terminal_id = terminal_id or self.terminal_id
         validation_result = {
             'article': rule_set.article,
+            'terminal_id': terminal_id,
             'price': rule_set.price,
             'api_rules_count': len(api_rules),
             'checks': []
@@ -367,10 +1676,6 @@ class RulesValidator:
             validation_result['message'] = 'Правила не найдены в API'
             return validation_result
         
-        logger.info(f"\n{'='*80}")
-        logger.info(f"🔍 Проверка артикула: {rule_set.article}")
-        logger.info(f"{'='*80}")
-        
         # Проверяем каждое из 5 правил
         rules_to_check = [
             ('Правило 0', rule_set.level_0, rule_set.rule_0),
@@ -380,71 +1685,27 @@ class RulesValidator:
             ('Правило 2-1', rule_set.p_value, rule_set.rule_2_1),
         ]
         
-        for rule_name, quantity, price_with_discount in rules_to_check:
-            # Цена без скидки
-            price_without_discount = round(quantity * rule_set.price, 2)
-            
-            # Ожидаемая скидка = цена без скидки - цена со скидкой
-            expected_discount = round(price_without_discount - price_with_discount, 2)
-            
-            logger.info(f"\n📋 {rule_name}:")
-            logger.info(f"   Количество: {quantity}")
-            logger.info(f"   Цена без скидки: {price_without_discount}")
-            logger.info(f"   Цена со скидкой: {price_with_discount}")
-            logger.info(f"   Ожидаемая скидка: {expected_discount}")
-            
-            # Тестируем через API
-            result = await self.api.test_discount_rule(
-                article=rule_set.article,
-                quantity=quantity,
-                price=rule_set.price,
-                terminal_id=self.terminal_id
-            )
-            
-            if result['success']:
-                actual_discount = result['total_discount']
-                difference = abs(expected_discount - actual_discount)
-                
-                # Определяем статус (допуск 0.01)
-                status = 'OK' if difference <= 0.01 else 'FAIL'
-                
-                check = ValidationCheck(
-                    rule_name=rule_name,
-                    quantity=quantity,
-                    price_without_discount=price_without_discount,
-                    price_with_discount=price_with_discount,
-                    expected_discount=expected_discount,
-                    actual_discount=actual_discount,
-                    difference=difference,
-                    status=status
-                )
-                
-                # Красивый вывод
-                if status == 'OK':
-                    logger.info(f"   ✅ API скидка: {actual_discount} - СОВПАДАЕТ")
-                else:
-                    logger.warning(f"   ❌ API скидка: {actual_discount} - РАСХОЖДЕНИЕ {difference}")
-                
-            else:
-                check = ValidationCheck(
-                    rule_name=rule_name,
-                    quantity=quantity,
-                    price_without_discount=price_without_discount,
-                    price_with_discount=price_with_discount,
-                    expected_discount=expected_discount,
-                    actual_discount=0,
-                    difference=expected_discount,
-                    status='ERROR',
-                    error=result.get('error', 'Unknown error')
-                )
-                logger.error(f"   ❌ Ошибка API: {check.error}")
-            
+        batched = self.batcher is not None and self._is_batchable(api_rules)
+        rules_fingerprint = TesterCache.fingerprint(api_rules) if self.cache else None
+        engine = DiscountEngine(api_rules) if self.offline_engine else None
+        
+        # Все проверки артикула идут параллельно, общий лимит задает семафор
+        checks = await asyncio.gather(*(
+            self._check_rule(rule_set, rule_name, quantity, price_with_discount, terminal_id,
+                             batched, rules_fingerprint, engine)
+            for rule_name, quantity, price_with_discount in rules_to_check
+        ))
+        
+        # Логируем после завершения, чтобы строки разных артикулов не перемешивались
+        for check in checks:
+            self._log_check(rule_set.article, terminal_id, check)
             validation_result['checks'].append(check)
         
         # Подсчет статистики
-        ok_count = sum(1 for c in validation_result['checks'] if c.status == 'OK')
-        fail_count = sum(1 for c in validation_result['checks'] if c.status == 'FAIL')
-        error_count = sum(1 for c in validation_result['checks'] if c.status == 'ERROR')
+        counts = {'OK': 0, 'FAIL': 0, 'ERROR': 0}
+        for check in validation_result['checks']:
+            counts[check.status] += 1
+        ok_count, fail_count, error_count = counts['OK'], counts['FAIL'], counts['ERROR']
         
         validation_result['status'] = 'COMPLETED'
         validation_result['ok_count'] = ok_count
@@ -452,109 +1713,557 @@ class RulesValidator:
         validation_result['error_count'] = error_count
         validation_result['message'] = f'Проверено 5 правил: ✅ {ok_count} | ❌ {fail_count} | ⚠️ {error_count}'
         
-        logger.info(f"\n📊 Итог: {validation_result['message']}")
+        logger.info("Артикул %s (терминал %s): %s", rule_set.article, terminal_id, validation_result['message'],
+                    extra={'fields': {'article': rule_set.article, 'terminal_id': terminal_id,
+                                      'ok': ok_count, 'fail': fail_count, 'error': error_count}})
         
         return validation_result
     
-    def export_to_excel(self, filename: str = "validation_results.xlsx"):
-        """Экспортирует результаты в Excel"""
-        rows = []
+    async def _check_rule(self, rule_set: RuleSet, rule_name: str, quantity: float,
+                          price_with_discount: float, terminal_id: int, batched: bool = False,
+                          rules_fingerprint: Optional[str] = None,
+                          engine: Optional[DiscountEngine] = None) -> ValidationCheck:
+        """Проверяет одно правило локально или через API"""
+        # Цена без скидки
+        price_without_discount = round(quantity * rule_set.price, 2)
         
-        for result in self.results:
-            article = result['article']
-            price = result['price']
-            status = result['status']
-            
-            if status == 'NO_API_RULES':
-                rows.append({
-                    'Артикул': article,
-                    'Цена': price,
-                    'Статус': 'Нет правил в API',
-                    'Правило': '',
-                    'Количество': '',
-                    'Сумма без скидки': '',
-                    'Сумма со скидкой': '',
-                    'Ожидаемая скидка': '',
-                    'Фактическая скидка (API)': '',
-                    'Расхождение': '',
-                    'Результат': '',
-                    'Ошибка': ''
-                })
+        # Ожидаемая скидка = цена без скидки - цена со скидкой
+        expected_discount = round(price_without_discount - price_with_discount, 2)
+        
+        # Тот же запрос при тех же правилах артикула берем из кэша
+        cache_key = None
+        result = None
+        if self.cache is not None:
+            cache_key = TesterCache.key(rule_set.article, quantity, rule_set.price,
+                                        terminal_id, rules_fingerprint)
+            result = self.cache.get(cache_key)
+        
+        # Локальный расчет: совпадение с ожиданием засчитываем без запроса (кроме выборки),
+        # расхождение и неизвестные случаи перепроверяем через тестер
+        predicted = None
+        verified_by = 'API'
+        if result is None and engine is not None:
+            predicted = engine.predict(quantity, rule_set.price, terminal_id)
+            if (predicted is not None and abs(expected_discount - predicted) <= 0.01
+                    and random.random() >= Config.OFFLINE_SAMPLE_RATE):
+                result = {'success': True, 'total_discount': predicted}
+                verified_by = 'Локально'
+                self.offline_checks += 1
+        
+        # Тестируем через API
+        if result is None:
+            if batched:
+                result = await self.batcher.submit(rule_set.article, quantity, rule_set.price, terminal_id)
             else:
-                for check in result['checks']:
-                    # Восстанавливаем детали из check
-                    quantity = check.quantity if hasattr(check, 'quantity') else ''
-                    price_without = check.price_without_discount if hasattr(check, 'price_without_discount') else ''
-                    price_with = check.price_with_discount if hasattr(check, 'price_with_discount') else ''
-                    
-                    rows.append({
-                        'Артикул': article,
-                        'Цена': price,
-                        'Статус': status,
-                        'Правило': check.rule_name,
-                        'Количество': quantity,
-                        'Сумма без скидки': price_without,
-                        'Сумма со скидкой': price_with,
-                        'Ожидаемая скидка': check.expected_discount,
-                        'Фактическая скидка (API)': check.actual_discount,
-                        'Расхождение': check.difference,
-                        'Результат': check.status,
-                        'Ошибка': check.error if check.error else ''
-                    })
-        
-        df = pd.DataFrame(rows)
-        
-        # Форматирование
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Результаты')
-            
-            # Получаем worksheet для форматирования
-            worksheet = writer.sheets['Результаты']
-            
-            # Устанавливаем ширину колонок
-            worksheet.column_dimensions['A'].width = 15  # Артикул
-            worksheet.column_dimensions['B'].width = 10  # Цена
-            worksheet.column_dimensions['C'].width = 20  # Статус
-            worksheet.column_dimensions['D'].width = 15  # Правило
-            worksheet.column_dimensions['E'].width = 12  # Количество
-            worksheet.column_dimensions['F'].width = 18  # Сумма без скидки
-            worksheet.column_dimensions['G'].width = 18  # Сумма со скидкой
-            worksheet.column_dimensions['H'].width = 18  # Ожидаемая скидка
-            worksheet.column_dimensions['I'].width = 22  # Фактическая скидка
-            worksheet.column_dimensions['J'].width = 15  # Расхождение
-            worksheet.column_dimensions['K'].width = 12  # Результат
-            worksheet.column_dimensions['L'].width = 30  # Ошибка
+                async with self.semaphore:
+                    result = await self.api.test_discount_rule(
+                        article=rule_set.article,
+                        quantity=quantity,
+                        price=rule_set.price,
+                        terminal_id=terminal_id
+                    )
             
-            # Форматируем заголовки
-            from openpyxl.styles import Font, PatternFill, Alignment
+            if cache_key is not None:
+                self.cache.put(cache_key, result)
             
-            header_fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
-            header_font = Font(bold=True, color='FFFFFF')
+            if predicted is not None and result['success'] and abs(predicted - result['total_discount']) > 0.01:
+                self.offline_mismatches += 1
+                logger.debug("%s: локальный расчет %s, API %s (количество %s, терминал %s)",
+                             rule_set.article, predicted, result['total_discount'], quantity, terminal_id)
+        
+        if result['success']:
+            actual_discount = result['total_discount']
+            difference = abs(expected_discount - actual_discount)
             
-            for cell in worksheet[1]:
-                cell.fill = header_fill
-                cell.font = header_font
-                cell.alignment = Alignment(horizontal='center', vertical='center')
+            # Определяем статус (допуск 0.01)
+            status = 'OK' if difference <= 0.01 else 'FAIL'
             
-            # Форматируем результаты (цветами)
-            for row in range(2, len(df) + 2):
-                result_cell = worksheet.cell(row=row, column=11)  # Колонка K (Результат)
-                
-                if result_cell.value == 'OK':
-                    result_cell.fill = PatternFill(start_color='C6EFCE', end_color='C6EFCE', fill_type='solid')
-                    result_cell.font = Font(color='006100')
-                elif result_cell.value == 'FAIL':
-                    result_cell.fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
-                    result_cell.font = Font(color='9C0006')
-                elif result_cell.value == 'ERROR':
-                    result_cell.fill = PatternFill(start_color='FFEB9C', end_color='FFEB9C', fill_type='solid')
-                    result_cell.font = Font(color='9C6500')
+            return ValidationCheck(
+                rule_name=rule_name,
+                quantity=quantity,
+                price_without_discount=price_without_discount,
+                price_with_discount=price_with_discount,
+                expected_discount=expected_discount,
+                actual_discount=actual_discount,
+                difference=difference,
+                status=status,
+                verified_by=verified_by
+            )
+        
+        return ValidationCheck(
+            rule_name=rule_name,
+            quantity=quantity,
+            price_without_discount=price_without_discount,
+            price_with_discount=price_with_discount,
+            expected_discount=expected_discount,
+            actual_discount=0,
+            difference=expected_discount,
+            status='ERROR',
+            error=result.get('error', 'Unknown error')
+        )
+    
+    def _log_check(self, article: str, terminal_id: int, check: ValidationCheck):
+        """Выводит результат одной проверки в лог (подробности - только на уровне DEBUG)"""
+        # Аргументы форматируются лениво, только если запись действительно пишется
+        logger.debug("%s | %s: количество %s, без скидки %s, со скидкой %s, ожидаемая скидка %s, API скидка %s - %s",
+                     article, check.rule_name, check.quantity, check.price_without_discount,
+                     check.price_with_discount, check.expected_discount, check.actual_discount, check.status)
+        
+        if check.status == 'FAIL':
+            logger.warning("❌ %s (терминал %s) %s: API скидка %s, ожидалась %s - РАСХОЖДЕНИЕ %s",
+                           article, terminal_id, check.rule_name, check.actual_discount,
+                           check.expected_discount, check.difference)
+        elif check.status == 'ERROR':
+            logger.error("❌ %s (терминал %s) %s: ошибка API: %s",
+                         article, terminal_id, check.rule_name, check.error)
+    
+    # Столбцы отчета и их ширина
+    REPORT_COLUMNS = [
+        ('Файл', 25),
+        ('Артикул', 15),
+        ('Терминал', 10),
+        ('Цена', 10),
+        ('Статус', 20),
+        ('Правило', 15),
+        ('Количество', 12),
+        ('Сумма без скидки', 18),
+        ('Сумма со скидкой', 18),
+        ('Ожидаемая скидка', 18),
+        ('Фактическая скидка (API)', 22),
+        ('Расхождение', 15),
+        ('Результат', 12),
+        ('Ошибка', 30),
+        ('Проверка', 12),
+        ('Зерно уровней', 14),
+    ]
+    
+    def export_to_excel(self, filename: str = "validation_results.xlsx", run_info: Dict = None):
+        """Экспортирует результаты в Excel (потоковая запись)"""
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.formatting.rule import CellIsRule
+        from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
+        from openpyxl.utils import get_column_letter
+        
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Результаты')
+        
+        # Устанавливаем ширину колонок
+        for index, (_, width) in enumerate(self.REPORT_COLUMNS, 1):
+            worksheet.column_dimensions[get_column_letter(index)].width = width
+        
+        # Форматируем заголовки одним именованным стилем
+        header_style = NamedStyle(
+            name='report_header',
+            fill=PatternFill(start_color='366092', end_color='366092', fill_type='solid'),
+            font=Font(bold=True, color='FFFFFF'),
+            alignment=Alignment(horizontal='center', vertical='center')
+        )
+        workbook.add_named_style(header_style)
+        
+        header = []
+        for title, _ in self.REPORT_COLUMNS:
+            cell = WriteOnlyCell(worksheet, value=title)
+            cell.style = header_style.name
+            header.append(cell)
+        worksheet.append(header)
+        
+        # Цвет результата задается условным форматированием на весь столбец "Результат"
+        result_column = get_column_letter([title for title, _ in self.REPORT_COLUMNS].index('Результат') + 1)
+        result_range = f'{result_column}2:{result_column}1048576'
+        result_styles = [
+            ('OK', 'C6EFCE', '006100'),
+            ('FAIL', 'FFC7CE', '9C0006'),
+            ('ERROR', 'FFEB9C', '9C6500'),
+        ]
+        for value, fill_color, font_color in result_styles:
+            worksheet.conditional_formatting.add(result_range, CellIsRule(
+                operator='equal',
+                formula=[f'"{value}"'],
+                fill=PatternFill(start_color=fill_color, end_color=fill_color, fill_type='solid'),
+                font=Font(color=font_color)
+            ))
+        
+        for row in self.results.rows():
+            worksheet.append(row)
+        
+        # Сводка по файлам для пакетной проверки
+        summary = self.results.by_source
+        if len(summary) > 1:
+            summary_sheet = workbook.create_sheet('По файлам')
+            summary_sheet.column_dimensions['A'].width = 40
+            summary_sheet.append(['Файл', 'Артикулов', 'Без правил', 'Успешно', 'Ошибки', 'API ошибки'])
+            for source, counts in summary.items():
+                summary_sheet.append([source, counts['total'], counts['no_rules'],
+                                      counts['ok'], counts['fail'], counts['error']])
+        
+        # Параметры запуска (зерно уровней и т.п.) для воспроизведения
+        if run_info:
+            info_sheet = workbook.create_sheet('Параметры запуска')
+            info_sheet.column_dimensions['A'].width = 25
+            info_sheet.column_dimensions['B'].width = 40
+            for key, value in run_info.items():
+                info_sheet.append([key, value])
+        
+        workbook.save(filename)
         
         logger.info(f"\n💾 Результаты сохранены в {filename}")
         return filename
 
 
-async def main():
+class CheckpointJournal:
+    """Журнал результатов (JSONL): дописывается по мере проверки артикулов"""
+    
+    def __init__(self, file_path: str, input_hash: str):
+        self.file_path = Path(file_path)
+        self.input_hash = input_hash
+        self._file = None
+    
+    @staticmethod
+    def file_hash(file_path: str) -> str:
+        """Хэш содержимого входного файла"""
+        digest = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    @classmethod
+    def files_hash(cls, file_paths: List[str]) -> str:
+        """Общий хэш набора входных файлов"""
+        if len(file_paths) == 1:
+            return cls.file_hash(file_paths[0])
+        
+        digest = hashlib.sha1()
+        for file_path in file_paths:
+            digest.update(f"{Path(file_path).name}:{cls.file_hash(file_path)}\n".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _read(self) -> Tuple[Optional[Dict], Dict[int, Dict]]:
+        """Читает заголовок и записанные результаты (по индексу строки)"""
+        if not self.file_path.exists():
+            return None, {}
+        
+        header = None
+        entries = {}
+        with open(self.file_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла оборваться при аварийном завершении
+                    continue
+                if header is None:
+                    header = record
+                else:
+                    entries[record['index']] = record
+        
+        return header, entries
+    
+    @staticmethod
+    def _to_result(record: Dict) -> Dict:
+        """Восстанавливает результат валидатора из записи журнала"""
+        result = dict(record['result'])
+        result['checks'] = [ValidationCheck(**check) for check in result['checks']]
+        return result
+    
+    @staticmethod
+    def content_hash(rule_set: RuleSet, api_rules: List[Dict], terminal_id: int) -> str:
+        """Хэш входных данных проверки: строка Excel (цена, K, L, P, Q), правила артикула в API,
+        сервер, дата чека и режим уровней.
+        
+        Зерно уровней в хэш не входит, иначе в случайном режиме ни одна строка не переносилась бы;
+        перенесенная строка хранит зерно своего запуска (столбец "Зерно уровней" в отчете).
+        """
+        inputs = [Config.BASE_URL, Config.TESTER_DATE, Config.LEVELS_MODE,
+                  rule_set.article, rule_set.price, rule_set.k_value, rule_set.l_value,
+                  rule_set.p_value, rule_set.q_value, terminal_id, TesterCache.fingerprint(api_rules)]
+        return hashlib.sha1(json.dumps(inputs, ensure_ascii=False).encode('utf-8')).hexdigest()
+    
+    def previous_results(self) -> Dict[str, Dict]:
+        """Результаты прошлого запуска по хэшу входных данных (кроме проверок с ошибками)"""
+        _, entries = self._read()
+        previous = {}
+        for record in entries.values():
+            content_hash = record.get('hash')
+            if content_hash and not record['result'].get('error_count'):
+                previous[content_hash] = self._to_result(record)
+        return previous
+    
+    def saved_seed(self) -> Optional[int]:
+        """Зерно уровней прерванного запуска того же входного файла"""
+        header, _ = self._read()
+        if header and header.get('input_hash') == self.input_hash:
+            return header.get('seed')
+        return None
+    
+    def open(self, resume: bool = False, seed: Optional[int] = None) -> Dict[int, Dict]:
+        """Открывает журнал; при resume возвращает уже проверенные артикулы"""
+        completed = {}
+        
+        if resume:
+            header, entries = self._read()
+            if header and header.get('input_hash') == self.input_hash:
+                completed = {index: self._to_result(record) for index, record in entries.items()}
+                logger.info(f"Продолжение проверки: в журнале {len(completed)} артикулов")
+            elif header:
+                logger.warning("Входной файл изменился с прошлого запуска, проверка начнется заново")
+        
+        if resume and completed:
+            self._file = open(self.file_path, 'a', encoding='utf-8')
+        else:
+            self._file = open(self.file_path, 'w', encoding='utf-8')
+            self._write({'input_hash': self.input_hash, 'seed': seed, 'created_at': time.time()})
+        
+        return completed
+    
+    def _write(self, record: Dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+    
+    def append(self, index: int, result: Dict, content_hash: Optional[str] = None):
+        """Записывает результат проверки артикула"""
+        record = dict(result)
+        record['checks'] = [asdict(check) for check in result['checks']]
+        self._write({'index': index, 'hash': content_hash, 'result': record})
+    
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class RuleSync:
+    """Синхронизация правил скидок с Excel по шаблону правила (manual.json)"""
+    
+    PRIORITY_FROM_TO = 55  # Скидка L за единицу от K до P
+    PRIORITY_FROM = 50  # Скидка Q за единицу от P
+    
+    def __init__(self, template: Dict, store_prefix: str):
+        self.template = template
+        self.store_prefix = store_prefix
+    
+    @staticmethod
+    def _format_number(value: float) -> str:
+        """Число в строковом виде, как его хранит сервер ("2", "20", "3.5")"""
+        return f"{round(value, 2):.2f}".rstrip('0').rstrip('.')
+    
+    @staticmethod
+    def _first_result(rule: Dict) -> Optional[Dict]:
+        """Первый результат первой шкалы правила"""
+        for scale_item in rule.get('resultScaleItems') or []:
+            for result_item in (scale_item or {}).get('results') or []:
+                if result_item:
+                    return result_item
+        return None
+    
+    def _bands(self, rule_set: RuleSet) -> Dict[int, Tuple[float, Optional[float], float]]:
+        """Ожидаемые диапазоны по приоритетам: (ОТ, ДО, скидка за единицу)"""
+        # ДО чуть меньше P, чтобы количество P попадало в правило с приоритетом 50
+        to_value = round(rule_set.p_value - Config.RULE_SYNC_BAND_GAP, 2)
+        return {
+            self.PRIORITY_FROM_TO: (rule_set.k_value, to_value, rule_set.l_value),
+            self.PRIORITY_FROM: (rule_set.p_value, None, rule_set.q_value),
+        }
+    
+    def _signature(self, rule: Dict) -> Optional[Tuple[float, Optional[float], float]]:
+        """(ОТ, ДО, скидка) существующего правила"""
+        result_item = self._first_result(rule)
+        if result_item is None:
+            return None
+        
+        from_value = None
+        to_value = None
+        for condition in (result_item.get('restriction') or {}).get('conditions') or []:
+            try:
+                value = float(condition.get('value'))
+            except (ValueError, TypeError):
+                continue
+            if condition.get('type') == 6:  # не менше (ОТ)
+                from_value = value
+            elif condition.get('type') == 1:  # не більше (ДО)
+                to_value = value
+        
+        try:
+            fixed_value = float(result_item.get('fixedValue'))
+        except (ValueError, TypeError):
+            return None
+        
+        return from_value, to_value, fixed_value
+    
+    @staticmethod
+    def _same_band(current: Optional[Tuple], expected: Tuple) -> bool:
+        if current is None:
+            return False
+        for a, b in zip(current, expected):
+            if (a is None) != (b is None):
+                return False
+            if a is not None and abs(a - b) > 0.001:
+                return False
+        return True
+    
+    def _apply_band(self, rule: Dict, band: Tuple[float, Optional[float], float]) -> bool:
+        """Записывает диапазон и скидку в первый результат правила (False - у правила нет результата)"""
+        from_value, to_value, fixed_value = band
+        result_item = self._first_result(rule)
+        if result_item is None or not isinstance(result_item.get('restriction'), dict):
+            return False
+        
+        conditions = [{"type": 6, "value": self._format_number(from_value)}]
+        if to_value is not None:
+            conditions.append({"type": 1, "value": self._format_number(to_value)})
+        
+        result_item['fixedValue'] = self._format_number(fixed_value)
+        result_item['restriction']['conditions'] = conditions
+        return True
+    
+    def _new_rule(self, name: str, priority: int, band: Tuple, sku_set: Tuple[int, str]) -> Dict:
+        """Новое правило по шаблону"""
+        rule = copy.deepcopy(self.template)
+        rule['id'] = None
+        rule['name'] = name
+        rule['priority'] = priority
+        
+        restriction = self._first_result(rule)['restriction']
+        restriction['skuSetId'], restriction['skuSetIdDesc'] = sku_set
+        
+        self._apply_band(rule, band)
+        return rule
+    
+    def _sku_set(self, rules: List[Dict]) -> Optional[Tuple[int, str]]:
+        """Набор SKU артикула из его существующих правил"""
+        for rule in rules:
+            restriction = (self._first_result(rule) or {}).get('restriction') or {}
+            if restriction.get('skuSetId'):
+                return restriction['skuSetId'], restriction.get('skuSetIdDesc', '')
+        return None
+    
+    def plan(self, rule_sets: List[RuleSet], rule_index: RuleIndex) -> Tuple[List[Dict], List[Dict], List[str]]:
+        """Сравнивает Excel с каталогом: правила для создания, для обновления и пропущенные артикулы"""
+        creates = []
+        updates = []
+        skipped = []
+        
+        # При повторе артикула в Excel берется последняя строка
+        latest = {rule_set.article: rule_set for rule_set in rule_sets}
+        
+        for article, rule_set in latest.items():
+            existing = rule_index.get(article, self.store_prefix)
+            by_priority = {}
+            for rule in existing:
+                by_priority.setdefault(rule.get('priority'), rule)
+            
+            for priority, band in self._bands(rule_set).items():
+                current = by_priority.get(priority)
+                
+                if current is not None:
+                    if not self._same_band(self._signature(current), band):
+                        rule = copy.deepcopy(current)
+                        if self._apply_band(rule, band):
+                            updates.append(rule)
+                        else:
+                            skipped.append(f"{article}: у правила {current.get('name')} нет результата с ограничением")
+                    continue
+                
+                sku_set = self._sku_set(existing)
+                if sku_set is None:
+                    skipped.append(f"{article}: нет набора SKU для приоритета {priority}")
+                    continue
+                
+                name = Config.RULE_SYNC_NAMES[priority].format(prefix=self.store_prefix, article=article)
+                creates.append(self._new_rule(name, priority, band, sku_set))
+        
+        return creates, updates, skipped
+
+
+async def sync_rules(dry_run: bool = False):
+    """Создает и обновляет правила скидок по столбцам K/L/P/Q Excel файла"""
+    print("\n" + "="*80)
+    print("🛠  СИНХРОНИЗАЦИЯ ПРАВИЛ СКИДОК С EXCEL")
+    print("="*80)
+    
+    if not Path(Config.EXCEL_FILE).exists():
+        error_msg = f"❌ Excel файл не найден: {Path(Config.EXCEL_FILE).absolute()}"
+        print(error_msg)
+        logger.error(error_msg)
+        return
+    
+    with open(Config.RULE_TEMPLATE_FILE, encoding='utf-8') as f:
+        template = json.load(f)
+    
+    rule_sets = ExcelParser(Config.EXCEL_FILE).parse()
+    if not rule_sets:
+        print("❌ Не найдено ни одной строки для обработки")
+        return
+    
+    async with DiscountRulesAPI(Config()) as api:
+        if not await api.ensure_login():
+            print("❌ Не удалось авторизоваться в системе")
+            return
+        
+        # Для сравнения нужен актуальный каталог, кэш не используем
+        rule_index = RuleIndex(await api.get_all_discount_rules(use_cache=False))
+        
+        sync = RuleSync(template, Config.STORE_PREFIX)
+        creates, updates, skipped = sync.plan(rule_sets, rule_index)
+        
+        print(f"\n📋 Создать: {len(creates)} | Обновить: {len(updates)} | Пропущено: {len(skipped)}")
+        logger.info(f"Синхронизация правил: создать {len(creates)}, обновить {len(updates)}, пропущено {len(skipped)}")
+        for reason in skipped:
+            logger.warning(f"Пропущено: {reason}")
+        
+        if dry_run or not (creates or updates):
+            return
+        
+        # Запросы идут через общий слой: ограничение частоты и повторы
+        results = await asyncio.gather(*(api.save_discount_rule(rule) for rule in creates + updates))
+        saved = sum(1 for result in results if result['success'])
+        
+        print(f"✅ Сохранено правил: {saved} | ❌ Ошибок: {len(results) - saved}")
+        logger.info(f"Сохранено правил: {saved}, ошибок: {len(results) - saved}")
+    
+    # Каталог изменился - локальный кэш правил больше не актуален
+    if Config.RULES_CACHE_FILE and Path(Config.RULES_CACHE_FILE).exists():
+        os.remove(Config.RULES_CACHE_FILE)
+
+
+def find_workbooks(pattern: str) -> List[str]:
+    """Excel файлы для пакетного режима: каталог или glob-шаблон"""
+    if Path(pattern).is_dir():
+        pattern = str(Path(pattern) / '*.xlsx')
+    
+    # Пропускаем временные файлы Excel и собственный отчет
+    return [
+        file_path for file_path in sorted(glob.glob(pattern))
+        if not Path(file_path).name.startswith('~$') and Path(file_path).name != 'validation_results.xlsx'
+    ]
+
+
+def parse_workbook(file_path: str, seed: int, levels_mode: str) -> List[RuleSet]:
+    """Разбирает один Excel файл (вызывается и в дочерних процессах)"""
+    return ExcelParser(file_path, seed=seed, levels_mode=levels_mode).parse()
+
+
+def parse_workbooks(files: List[str], seed: int, levels_mode: str) -> List[List[RuleSet]]:
+    """Разбирает Excel файлы, несколько файлов - параллельно в пуле процессов"""
+    if len(files) == 1:
+        return [parse_workbook(files[0], seed, levels_mode)]
+    
+    workers = min(len(files), os.cpu_count() or 1)
+    
+    # Записи лога дочерних процессов пишет поток родительского процесса в те же файл и консоль
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *_log_handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker_logging,
+                                 initargs=(log_queue,)) as pool:
+            return list(pool.map(parse_workbook, files, repeat(seed), repeat(levels_mode)))
+    finally:
+        listener.stop()
+
+
+async def main(resume: bool = False, batch: str = None, full: bool = False):
     """Основная функция программы"""
     print("\n" + "="*80)
     print("🚀 ПРОГРАММА ПРОВЕРКИ ПРАВИЛ СКИДОК")
@@ -564,8 +2273,19 @@ async def main():
     logger.info("Запуск программы проверки правил скидок")
     logger.info("="*80)
     
+    # Пакетный режим: несколько Excel файлов в одном запуске
+    if batch:
+        excel_files = find_workbooks(batch)
+        if not excel_files:
+            error_msg = f"❌ Не найдено Excel файлов: {batch}"
+            print(error_msg)
+            logger.error(error_msg)
+            return
+    else:
+        excel_files = [Config.EXCEL_FILE]
+    
     # Проверяем наличие Excel файла
-    excel_path = Path(Config.EXCEL_FILE)
+    excel_path = Path(excel_files[0])
     if not excel_path.exists():
         error_msg = f"❌ Excel файл не найден: {excel_path.absolute()}"
         print(error_msg)
@@ -574,11 +2294,24 @@ async def main():
         return
     
     # Парсим Excel и создаем наборы правил
-    print("\n📂 Шаг 1: Парсинг Excel файла...")
-    logger.info("Шаг 1: Парсинг Excel файла")
+    print(f"\n📂 Шаг 1: Парсинг Excel файлов ({len(excel_files)})...")
+    logger.info(f"Шаг 1: Парсинг Excel файлов: {', '.join(excel_files)}")
+    
+    journal = CheckpointJournal(Config.CHECKPOINT_FILE, CheckpointJournal.files_hash(excel_files))
     
-    parser = ExcelParser(Config.EXCEL_FILE)
-    rule_sets = parser.parse()
+    # При продолжении берем зерно прерванного запуска, чтобы уровни совпали
+    seed = journal.saved_seed() if resume else None
+    if seed is None:
+        seed = Config.RANDOM_SEED if Config.RANDOM_SEED is not None else random.randrange(2 ** 32)
+    
+    parsed = parse_workbooks(excel_files, seed, Config.LEVELS_MODE)
+    
+    # Для каждого набора правил запоминаем файл-источник
+    sources = []
+    rule_sets = []
+    for file_path, file_rule_sets in zip(excel_files, parsed):
+        sources.extend([Path(file_path).name] * len(file_rule_sets))
+        rule_sets.extend(file_rule_sets)
     
     if not rule_sets:
         error_msg = "❌ Не найдено ни одной строки для обработки"
@@ -612,43 +2345,121 @@ async def main():
     async with DiscountRulesAPI(Config()) as api:
         # Авторизация
         print("\n🔐 Авторизация...")
-        if not await api.login():
+        if not await api.ensure_login():
             error_msg = "❌ Не удалось авторизоваться в системе"
             print(error_msg)
             logger.error(error_msg)
             return
         print("✅ Авторизация успешна")
         
-        # Получаем правила
+        # Получаем правила: каталог загружается один раз, поиск - по магазину каждого файла.
+        # Отпечаток правил в ключе кэша тестера, хэш дифференциальной проверки и локальный расчет
+        # должны опираться на текущие правила сервера, поэтому тогда локальный кэш каталога не используется
         print(f"\n🔍 Поиск правил для {len(articles)} артикулов...")
-        rules_by_article = await api.find_rules_by_articles(articles)
+        differential = Config.DIFFERENTIAL_VALIDATION and not full
+        use_rules_cache = not (Config.TESTER_CACHE_SIZE or differential or Config.OFFLINE_ENGINE)
+        rules_by_source = {}
+        for file_path, file_rule_sets in zip(excel_files, parsed):
+            name = Path(file_path).name
+            store_prefix = Config.STORE_PREFIX_BY_FILE.get(name, Config.STORE_PREFIX)
+            rules_by_source[name] = await api.find_rules_by_articles(
+                [rs.article for rs in file_rule_sets], store_prefix=store_prefix, use_cache=use_rules_cache
+            )
         
         # Валидация
         print("\n" + "="*80)
         print("✓ Шаг 3: Проверка правил через API")
         print("="*80)
         
-        validator = RulesValidator(api, terminal_id=1541)
+        # На диске кэш полезен, только если уровни (а значит и ключи) повторяются между запусками
+        levels_repeat = Config.LEVELS_MODE == 'deterministic' or Config.RANDOM_SEED is not None or resume
+        tester_cache = None
+        if Config.TESTER_CACHE_SIZE:
+            tester_cache = TesterCache(Config.TESTER_CACHE_SIZE,
+                                       Config.TESTER_CACHE_FILE if levels_repeat else None)
+        terminal_ids = Config.TERMINAL_IDS
+        validator = RulesValidator(api, terminal_id=terminal_ids[0], max_concurrency=Config.MAX_CONCURRENCY,
+                                   cache=tester_cache)
+        
+        # Результаты прошлого запуска для артикулов, у которых не изменились ни строка Excel, ни правила
+        previous = {}
+        if differential:
+            previous = journal.previous_results()
+        carried = 0
         
-        total_articles = len(rule_sets)
-        for idx, rule_set in enumerate(rule_sets, 1):
-            print(f"\n[{idx}/{total_articles}] Проверка артикула {rule_set.article}...")
+        # Каждый проверенный артикул сразу попадает в журнал и в итоги отчета (validator.results)
+        done = journal.open(resume=resume, seed=seed)
+        
+        # Матрица артикул × терминал: правила и наборы правил общие для всех терминалов
+        total_articles = len(rule_sets) * len(terminal_ids)
+        completed = len(done)
+        
+        async def validate_article(index: int, rule_set: RuleSet, source: str, terminal_id: int):
+            nonlocal completed, carried
+            saved = done.get(index)
+            if (saved is not None and saved['article'] == rule_set.article
+                    and saved.get('terminal_id') == terminal_id and saved.get('source') == source):
+                validator.results.add(saved, index)
+                return
+            
+            api_rules = rules_by_source[source].get(rule_set.article, [])
+            content_hash = CheckpointJournal.content_hash(rule_set, api_rules, terminal_id)
+            
+            # Входные данные не изменились - переносим прошлый результат без запросов к тестеру
+            unchanged = previous.get(content_hash)
+            if unchanged is not None:
+                result = dict(unchanged, source=source)
+                journal.append(index, result, content_hash)
+                validator.results.add(result, index)
+                carried += 1
+                completed += 1
+                return
             
-            api_rules = rules_by_article.get(rule_set.article, [])
-            result = await validator.validate(rule_set, api_rules)
-            validator.results.append(result)
+            result = await validator.validate(rule_set, api_rules, terminal_id=terminal_id)
+            result['source'] = source
+            result['seed'] = seed
+            journal.append(index, result, content_hash)
+            validator.results.add(result, index)
+            completed += 1
             
+            print(f"\n[{completed}/{total_articles}] Проверка артикула {rule_set.article} (терминал {terminal_id})...")
             if result['status'] == 'NO_API_RULES':
                 print(f"   ⚠️  {result['message']}")
             else:
                 print(f"   📊 {result['message']}")
+        
+        try:
+            await asyncio.gather(*(
+                validate_article(row * len(terminal_ids) + column, rule_set, sources[row], terminal_id)
+                for row, rule_set in enumerate(rule_sets)
+                for column, terminal_id in enumerate(terminal_ids)
+            ))
+        finally:
+            journal.close()
+            if carried:
+                print(f"\n♻️  Без изменений с прошлого запуска: {carried} из {total_articles} (результаты перенесены)")
+                logger.info(f"Перенесено результатов прошлого запуска: {carried} из {total_articles}")
+            if validator.offline_engine:
+                logger.info(f"Локальный расчет: {validator.offline_checks} проверок без запроса, "
+                            f"{validator.offline_mismatches} расхождений с API")
+            if tester_cache:
+                logger.info(f"Кэш тестера: {tester_cache.hits} попаданий, {tester_cache.misses} запросов к API")
+                tester_cache.close()
     
     # Сохраняем в Excel
     print("\n" + "="*80)
     print("💾 Сохранение результатов...")
     print("="*80)
     
-    excel_file = validator.export_to_excel("validation_results.xlsx")
+    run_info = {
+        'Excel файлы': ', '.join(excel_files),
+        'Режим уровней': Config.LEVELS_MODE,
+        'Зерно генератора': seed,
+        'Терминалы': ', '.join(str(terminal_id) for terminal_id in Config.TERMINAL_IDS),
+        # Перенесенные строки проверены с уровнями своего запуска: см. столбец "Зерно уровней"
+        'Перенесено из прошлых запусков': carried,
+    }
+    excel_file = validator.export_to_excel("validation_results.xlsx", run_info=run_info)
     print(f"✅ Файл сохранен: {excel_file}")
     
     # Итоговая статистика
@@ -656,13 +2467,14 @@ async def main():
     print("📊 ИТОГОВАЯ СТАТИСТИКА")
     print("="*80)
     
-    total = len(validator.results)
-    with_rules = sum(1 for r in validator.results if r['status'] == 'COMPLETED')
-    without_rules = sum(1 for r in validator.results if r['status'] == 'NO_API_RULES')
+    totals = validator.results.totals
+    total = totals['total']
+    with_rules = totals['completed']
+    without_rules = totals['no_rules']
     
-    total_ok = sum(r.get('ok_count', 0) for r in validator.results)
-    total_fail = sum(r.get('fail_count', 0) for r in validator.results)
-    total_error = sum(r.get('error_count', 0) for r in validator.results)
+    total_ok = totals['ok']
+    total_fail = totals['fail']
+    total_error = totals['error']
     
     print(f"\n📦 Всего артикулов: {total}")
     print(f"✅ Проверено: {with_rules}")
@@ -672,6 +2484,23 @@ async def main():
     print(f"   ❌ Ошибки: {total_fail}")
     print(f"   ⚠️  API ошибки: {total_error}")
     
+    # Разбивка по файлам
+    if len(excel_files) > 1:
+        print("\n📁 По файлам:")
+        for source, counts in validator.results.by_source.items():
+            print(f"   {source}: артикулов {counts['total']} | ✅ {counts['ok']} | ❌ {counts['fail']} | ⚠️ {counts['error']}")
+            logger.info(f"{source}: артикулов {counts['total']}, успешно {counts['ok']}, "
+                        f"ошибок {counts['fail']}, API ошибок {counts['error']}")
+    
+    # Разбивка по терминалам
+    if len(Config.TERMINAL_IDS) > 1:
+        print("\n🏪 По терминалам:")
+        for terminal_id in Config.TERMINAL_IDS:
+            counts = validator.results.by_terminal.get(terminal_id, dict.fromkeys(ResultStore.COUNTERS, 0))
+            ok, fail, error = counts['ok'], counts['fail'], counts['error']
+            print(f"   Терминал {terminal_id}: ✅ {ok} | ❌ {fail} | ⚠️ {error}")
+            logger.info(f"Терминал {terminal_id}: успешно {ok}, ошибок {fail}, API ошибок {error}")
+    
     print("\n" + "="*80)
     print("✅ ПРОГРАММА ЗАВЕРШЕНА")
     print("="*80)
@@ -691,8 +2520,30 @@ async def main():
 
 
 if __name__ == "__main__":
+    # Нужно для пула процессов в собранном exe
+    multiprocessing.freeze_support()
+    
+    # Только в основном процессе: дочерние процессы пула пишут лог через init_worker_logging
+    setup_logging()
+    
+    arg_parser = argparse.ArgumentParser(description="Проверка правил скидок")
+    arg_parser.add_argument('--resume', action='store_true',
+                            help="продолжить прерванную проверку того же Excel файла")
+    arg_parser.add_argument('--batch', metavar='ПУТЬ',
+                            help="каталог или glob-шаблон Excel файлов для пакетной проверки")
+    arg_parser.add_argument('--full', action='store_true',
+                            help="перепроверить все артикулы, а не только измененные с прошлого запуска")
+    arg_parser.add_argument('--sync-rules', action='store_true',
+                            help="создать/обновить правила скидок по столбцам K/L/P/Q Excel файла")
+    arg_parser.add_argument('--dry-run', action='store_true',
+                            help="вместе с --sync-rules: только показать, что будет изменено")
+    args = arg_parser.parse_args()
+    
     try:
-        asyncio.run(main())
+        if args.sync_rules:
+            asyncio.run(sync_rules(dry_run=args.dry_run))
+        else:
+            asyncio.run(main(resume=args.resume, batch=args.batch, full=args.full))
     except KeyboardInterrupt:
         logger.info("\nПрограмма прервана пользователем")
     except Exception as e:
@@ -1,4 +1,11 @@
 # -*- mode: python ; coding: utf-8 -*-
+# pyinstaller discount_checker.spec              - один exe (распаковывается во временную папку при каждом запуске)
+# pyinstaller discount_checker.spec -- --onedir  - папка dist\discount_checker\ (быстрый запуск без распаковки)
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--onedir', action='store_true')
+options = parser.parse_args()
 
 
 a = Analysis(
@@ -10,28 +17,62 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    # pandas (нужен только p.py/p2.py), необязательные зависимости numpy/openpyxl и GUI/тесты
+    excludes=[
+        'tkinter', 'IPython', 'matplotlib', 'scipy',
+        'pyarrow', 'numexpr', 'bottleneck', 'tables', 'sqlalchemy', 'lxml',
+        'jinja2', 'PIL', 'pandas', 'numpy.tests',
+    ],
     noarchive=False,
 )
 pyz = PYZ(a.pure)
 
-exe = EXE(
-    pyz,
-    a.scripts,
-    a.binaries,
-    a.datas,
-    [],
-    name='discount_checker',
-    debug=False,
-    bootloader_ignore_signals=False,
-    strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
-    console=False,
-    disable_windowed_traceback=False,
-    argv_emulation=False,
-    target_arch=None,
-    codesign_identity=None,
-    entitlements_file=None,
-)
+if options.onedir:
+    exe = EXE(
+        pyz,
+        a.scripts,
+        [],
+        exclude_binaries=True,
+        name='discount_checker',
+        debug=False,
+        bootloader_ignore_signals=False,
+        strip=False,
+        upx=False,
+        console=False,
+        disable_windowed_traceback=False,
+        argv_emulation=False,
+        target_arch=None,
+        codesign_identity=None,
+        entitlements_file=None,
+    )
+    # Библиотеки без UPX: не нужно распаковывать их при каждом запуске
+    coll = COLLECT(
+        exe,
+        a.binaries,
+        a.datas,
+        strip=False,
+        upx=False,
+        upx_exclude=[],
+        name='discount_checker',
+    )
+else:
+    exe = EXE(
+        pyz,
+        a.scripts,
+        a.binaries,
+        a.datas,
+        [],
+        name='discount_checker',
+        debug=False,
+        bootloader_ignore_signals=False,
+        strip=False,
+        upx=True,
+        upx_exclude=[],
+        runtime_tmpdir=None,
+        console=False,
+        disable_windowed_traceback=False,
+        argv_emulation=False,
+        target_arch=None,
+        codesign_identity=None,
+        entitlements_file=None,
+    )
@@ -1,9 +1,10 @@
 import asyncio
 import aiohttp
+import bisect
 import ssl
 import pandas as pd
 import random
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 from dataclasses import dataclass
 import logging
 from pathlib import Path
@@ -312,7 +313,7 @@ class DiscountRulesAPI:
         
         logger.info(f"\n📤 Запрос к discountRuleTester/process:")
         logger.info(f"   Article: {article}, Quantity: {quantity}, Price: {price}, TerminalId: {terminal_id}")
-        logger.info(f"   Payload: {payload}")
+        logger.debug("   Payload: %s", payload)
         
         try:
             async with self.session.post(url, json=payload, headers=headers, cookies=self.cookies) as response:
@@ -416,6 +417,110 @@ class ValidationCheck:
     error: str = None
 
 
+@dataclass
+class QuantityBand:
+    """Скомпилированный диапазон количества одного результата правила из API"""
+    priority: int
+    quantity_from: float
+    quantity_to: Optional[float]  # None - правило без ДО (приоритет 50)
+    discount_value_type: Optional[int]
+    fixed_value: Optional[str]
+    rule_order: int  # Позиция правила в исходном списке
+    rule: Dict
+
+
+class QuantityBandIndex:
+    """Диапазоны правил одного артикула, отсортированные по количеству ОТ"""
+    
+    PRIORITY_FROM_TO = 55  # Правило с ОТ и ДО
+    PRIORITY_FROM = 50  # Правило только с ОТ
+    
+    def __init__(self, api_rules: List[Dict]):
+        bands = []
+        
+        for rule_order, rule in enumerate(api_rules or []):
+            if rule and isinstance(rule, dict):
+                bands.extend(self._compile_rule(rule, rule_order))
+        
+        bands.sort(key=lambda band: band.quantity_from)
+        self._bands = bands
+        self._starts = [band.quantity_from for band in bands]
+    
+    @classmethod
+    def _compile_rule(cls, rule: Dict, rule_order: int) -> List[QuantityBand]:
+        """Разбирает resultScaleItems → results → restriction → conditions один раз"""
+        priority = rule.get('priority', 0)
+        
+        # Проверяем только правила с приоритетом 55 или 50
+        if priority not in (cls.PRIORITY_FROM_TO, cls.PRIORITY_FROM):
+            return []
+        
+        bands = []
+        
+        for scale_item in rule.get('resultScaleItems') or []:
+            if not scale_item or not isinstance(scale_item, dict):
+                continue
+            
+            for result_item in scale_item.get('results') or []:
+                if not result_item or not isinstance(result_item, dict):
+                    continue
+                
+                restriction = result_item.get('restriction')
+                if not restriction or not isinstance(restriction, dict):
+                    continue
+                
+                # Ищем условия типа 6 (не менше) и 1 (не більше)
+                from_value = None
+                to_value = None
+                
+                for condition in restriction.get('conditions') or []:
+                    if not condition or not isinstance(condition, dict):
+                        continue
+                    
+                    try:
+                        cond_value = float(condition.get('value'))
+                    except (ValueError, TypeError):
+                        continue
+                    
+                    if condition.get('type') == 6:  # не менше (ОТ)
+                        from_value = cond_value
+                    elif condition.get('type') == 1:  # не більше (ДО)
+                        to_value = cond_value
+                
+                if from_value is None:
+                    continue
+                
+                # Приоритет 55 должен иметь оба условия (ОТ-ДО), приоритет 50 - только ОТ
+                if priority == cls.PRIORITY_FROM_TO and to_value is None:
+                    continue
+                if priority == cls.PRIORITY_FROM and to_value is not None:
+                    continue
+                
+                bands.append(QuantityBand(
+                    priority=priority,
+                    quantity_from=from_value,
+                    quantity_to=to_value,
+                    discount_value_type=result_item.get('discountValueType'),
+                    fixed_value=result_item.get('fixedValue'),
+                    rule_order=rule_order,
+                    rule=rule
+                ))
+        
+        return bands
+    
+    def find(self, quantity: float) -> List[Dict]:
+        """Правила, диапазон которых содержит количество (в исходном порядке)"""
+        # Кандидаты - все диапазоны с ОТ <= quantity
+        end = bisect.bisect_right(self._starts, quantity)
+        
+        matched = {}
+        for band in self._bands[:end]:
+            if band.quantity_to is None or quantity <= band.quantity_to:
+                matched.setdefault(band.rule_order, band.rule)
+        
+        return [matched[order] for order in sorted(matched)]
+
+
 class RulesValidator:
     """Валидатор правил"""
     
@@ -452,6 +557,9 @@ class RulesValidator:
             ('Правило 2-1', rule_set.p_value, rule_set.rule_2_1),
         ]
         
+        # Диапазоны количества правил артикула компилируем один раз на все проверки
+        band_index = QuantityBandIndex(api_rules)
+        
         for rule_name, quantity, price_with_discount in rules_to_check:
             # Цена без скидки
             price_without_discount = round(quantity * rule_set.price, 2)
@@ -466,7 +574,7 @@ class RulesValidator:
             logger.info(f"   Ожидаемая скидка: {expected_discount}")
             
             # Ищем пару правил в API (приоритет 55 и 50)
-            found_rules = self._find_matching_rules(api_rules, quantity, rule_set.price)
+            found_rules = self._find_matching_rules(band_index, quantity, rule_set.price)
             
             if found_rules:
                 logger.info(f"   📌 Найдены правила в API:")
@@ -548,91 +656,9 @@ class RulesValidator:
         
         return validation_result
     
-    def _find_matching_rules(self, api_rules: List[Dict], quantity_from: float, price: float) -> List[Dict]:
+    def _find_matching_rules(self, band_index: QuantityBandIndex, quantity_from: float, price: float) -> List[Dict]:
         """Находит правила с приоритетом 55 (с ДО) и 50 (без ДО) для заданного количества"""
-        matching_rules = []
-        
-        if not api_rules:
-            return matching_rules
-        
-        for rule in api_rules:
-            if not rule or not isinstance(rule, dict):
-                continue
-                
-            priority = rule.get('priority', 0)
-            
-            # Проверяем только правила с приоритетом 55 или 50
-            if priority not in [55, 50]:
-                continue
-            
-            # Ищем в resultScaleItems
-            result_scale_items = rule.get('resultScaleItems', [])
-            if not result_scale_items:
-                continue
-                
-            for scale_item in result_scale_items:
-                if not scale_item or not isinstance(scale_item, dict):
-                    continue
-                    
-                results = scale_item.get('results', [])
-                if not results:
-                    continue
-                    
-                for result_item in results:
-                    if not result_item or not isinstance(result_item, dict):
-                        continue
-                        
-                    restriction = result_item.get('restriction')
-                    if not restriction or not isinstance(restriction, dict):
-                        continue
-                        
-                    conditions = restriction.get('conditions', [])
-                    if not conditions:
-                        continue
-                    
-                    # Ищем условия типа 6 (не менше) и 1 (не більше)
-                    has_from = False
-                    has_to = False
-                    from_value = None
-                    to_value = None
-                    
-                    for condition in conditions:
-                        if not condition or not isinstance(condition, dict):
-                            continue
-                            
-                        cond_type = condition.get('type')
-                        cond_value_str = condition.get('value')
-                        
-                        if cond_value_str is None:
-                            continue
-                            
-                        try:
-                            cond_value = float(cond_value_str)
-                        except (ValueError, TypeError):
-                            continue
-                        
-                        if cond_type == 6:  # не менше (ОТ)
-                            has_from = True
-                            from_value = cond_value
-                        elif cond_type == 1:  # не більше (ДО)
-                            has_to = True
-                            to_value = cond_value
-                    
-                    # Приоритет 55 должен иметь оба условия (ОТ-ДО)
-                    if priority == 55 and has_from and has_to:
-                        if from_value is not None and to_value is not None:
-                            if from_value <= quantity_from <= to_value:
-                                matching_rules.append(rule)
-                                break
-                    
-                    # Приоритет 50 должен иметь только условие ОТ
-                    elif priority == 50 and has_from and not has_to:
-                        if from_value is not None:
-                            if from_value <= quantity_from:
-                                matching_rules.append(rule)
-                                break
-        
-        return matching_rules
+        return band_index.find(quantity_from)
     
     def export_to_excel(self, filename: str = "validation_results.xlsx"):
         """Экспортирует результаты в Excel"""
@@ -0,0 +1,111 @@
+"""Замер времени запуска: от старта процесса до первого HTTP-запроса к серверу.
+
+Программа запускается во временной папке с копией Excel файла и адресом локального
+сервера (DISCOUNT_CHECKER_BASE_URL). Сервер отвечает 401 на любой запрос, поэтому
+программа завершается сразу после первой попытки авторизации - настоящий сервер,
+кэши, журнал и отчет в папке проекта не затрагиваются.
+
+    python startup_benchmark.py                                   # исходный скрипт
+    python startup_benchmark.py --exe dist/discount_checker/discount_checker
+    python startup_benchmark.py --exe dist/discount_checker --runs 10
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+PROJECT_DIR = Path(__file__).resolve().parent
+
+
+class FirstRequestHandler(BaseHTTPRequestHandler):
+    """Запоминает время первого запроса и отвечает 401"""
+
+    def do_POST(self):
+        if self.server.first_request_at is None:
+            self.server.first_request_at = time.perf_counter()
+            self.server.first_request_path = self.path
+            self.server.first_request.set()
+        self.send_response(401)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+def measure(command, excel_file: Path, timeout: float) -> float:
+    """Один запуск: секунд от старта процесса до первого запроса"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FirstRequestHandler)
+    server.first_request_at = None
+    server.first_request_path = None
+    server.first_request = threading.Event()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        shutil.copy(excel_file, Path(work_dir) / 'data.xlsx')
+        env = dict(os.environ, DISCOUNT_CHECKER_BASE_URL=f"http://127.0.0.1:{server.server_port}")
+
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=work_dir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = started + timeout
+            while not server.first_request.wait(0.01):
+                if process.poll() is not None:
+                    raise RuntimeError(f"Программа завершилась без запросов к серверу (код {process.returncode})")
+                if time.perf_counter() > deadline:
+                    raise RuntimeError(f"Нет запроса к серверу за {timeout} с")
+            return server.first_request_at - started
+        finally:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            server.shutdown()
+            server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время от запуска до первого запроса к API")
+    parser.add_argument('--exe', metavar='ПУТЬ',
+                        help="собранный exe или папка onedir-сборки (по умолчанию - discount_checker.py)")
+    parser.add_argument('--excel', default=str(PROJECT_DIR / 'data.xlsx'),
+                        help="Excel файл, который разбирается до первого запроса")
+    parser.add_argument('--runs', type=int, default=5, help="число запусков")
+    parser.add_argument('--timeout', type=float, default=120, help="секунд ожидания одного запуска")
+    args = parser.parse_args()
+
+    if args.exe:
+        exe = Path(args.exe).resolve()
+        if exe.is_dir():
+            exe = exe / 'discount_checker'
+        command = [str(exe)]
+    else:
+        command = [sys.executable, str(PROJECT_DIR / 'discount_checker.py')]
+
+    print(f"Команда: {' '.join(command)}")
+    print(f"Excel: {args.excel}")
+
+    timings = []
+    for run in range(1, args.runs + 1):
+        elapsed = measure(command, Path(args.excel), args.timeout)
+        timings.append(elapsed)
+        print(f"  запуск {run}: {elapsed:.3f} с")
+
+    print(f"\nДо первого запроса: мин {min(timings):.3f} с | медиана {statistics.median(timings):.3f} с "
+          f"| макс {max(timings):.3f} с")
+
+
+if __name__ == "__main__":
+    main()